@@ -1,26 +1,33 @@
-class StandardResultsSetPagination(PageNumberPagination):
-    page_size = 2
+class ProductCursorPagination(CursorPagination):
+    page_size = 24
     page_size_query_param = "page_size"
-    max_page_size = 2
-
-    def get_paginated_response(self, data):
-        def _num_pages(pages):
-            num_pages = []
-            for num in range(1, pages + 1):
-                num_pages.append(num)
-            return num_pages
-
-        return Response(
-            {
-                "links": {
-                    "next": self.get_next_link(),
-                    "previous": self.get_previous_link(),
-                },
-                "count": self.page.paginator.count,
-                "num_pages": _num_pages(self.page.paginator.num_pages),
-                "results": data,
-            }
+    max_page_size = 100
+    ordering = ("sort_price", "id")
+
+
+def stream_products(queryset, context, chunk_size=200):
+    """
+    Serialize a product queryset as NDJSON in chunks of ``chunk_size`` products.
+
+    Only the ids are streamed from the database, every chunk is loaded with the
+    eager loading of the serializer so memory stays bounded by the chunk size.
+    """
+    ids = queryset.values_list("id", flat=True).iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(itertools.islice(ids, chunk_size))
+        if not chunk:
+            break
+        products = serializers.ProductSerializer.setup_eager_loading(
+            Product.objects.select_related("vendor").filter(id__in=chunk)
+        ).in_bulk()
+        serializer = serializers.ProductSerializer(
+            [products[pk] for pk in chunk if pk in products],
+            context=dict(context),
+            many=True,
         )
+        for product in serializer.data:
+            yield json.dumps(product, cls=encoders.JSONEncoder) + "\n"
+
 
 class ReviewSectionApiView(viewsets.ModelViewSet):
     queryset = ProductReview.objects.all()
@@ -33,10 +40,11 @@ class ReviewSectionApiView(viewsets.ModelViewSet):
             pk = request.data.get("product_id")
         recent_users = ProductReview.objects.filter(product__id=pk)
 
-        page = self.paginate_queryset(recent_users)
+        paginator = ReviewCursorPagination()
+        page = paginator.paginate_queryset(recent_users, request, view=self)
         if page is not None:
             serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
+            return paginator.get_paginated_response(serializer.data)
 
         serializer = self.get_serializer(recent_users, many=True)
         return Response(serializer.data)
@@ -52,15 +60,34 @@ class ProductApiView(viewsets.ModelViewSet):
         queryset = self.get_serializer_class().setup_eager_loading(queryset)
         return queryset
 
-    @action(detail=False, methods=["get"])
-    def vendor_products(self, request, pk=None):
-        products = Product.objects.filter(vendor=self.request.user.vendor).order_by(
-            "stockrecords__price_excl_tax"
+    def list_products(self, request, queryset, ordering):
+        """
+        Cursor paginated product list, ``?stream=true`` streams every product as
+        NDJSON instead.
+        """
+        queryset = queryset.annotate(
+            sort_price=Coalesce(Min("stockrecords__price_excl_tax"), 0)
+        ).order_by(*ordering)
+        if request.query_params.get("stream") in ("1", "true"):
+            return StreamingHttpResponse(
+                stream_products(queryset, {"request": request}),
+                content_type="application/x-ndjson",
+            )
+        paginator = ProductCursorPagination()
+        paginator.ordering = ordering
+        queryset = serializers.ProductSerializer.setup_eager_loading(
+            queryset.select_related("vendor")
         )
+        page = paginator.paginate_queryset(queryset, request, view=self)
         serializer = serializers.ProductSerializer(
-            products, context={"request": request}, many=True
+            page, context={"request": request}, many=True
         )
-        return Response(serializer.data)
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=False, methods=["get"])
+    def vendor_products(self, request, pk=None):
+        products = Product.objects.filter(vendor=self.request.user.vendor)
+        return self.list_products(request, products, ("sort_price", "id"))
 
     @action(detail=False, methods=["post"])
     def vendor_products_search(self, request, pk=None):
@@ -68,23 +95,20 @@ class ProductApiView(viewsets.ModelViewSet):
         price = request.data.get("price")
         # reviews = request.data.get("reviews")
         status = request.data.get("status")
-        queryset = Product.objects.order_by("stockrecords__price_excl_tax")
+        queryset = Product.objects.all()
+        ordering = ("sort_price", "id")
         if search:
-            queryset = Product.objects.filter(
-                Q(title__istartswith=search) | Q(description__istartswith=search)
-            )
+            queryset = ProductSearchDocument.search(queryset, search)
+            ordering = ("-rank", "id")
         if price == "high_low":
-            queryset = queryset.order_by("-stockrecords__price_excl_tax")
+            ordering = ("-sort_price", "-id")
         if price == "low_high":
-            queryset = queryset.order_by("stockrecords__price_excl_tax")
+            ordering = ("sort_price", "id")
         if status == "draft":
             queryset = queryset.filter(is_public=False)
         if status == "live":
             queryset = queryset.filter(is_public=True)
-        serializer = serializers.ProductSerializer(
-            queryset, context={"request": request}, many=True
-        )
-        return Response(serializer.data)
+        return self.list_products(request, queryset, ordering)
 
 class IncomeTrackerApiView(APIView):
     def _line_chart(self, label, values, category_count):
@@ -123,251 +147,171 @@ class IncomeTrackerApiView(APIView):
         }
         return dataset
 
-    def _get_correct_day(self, day_number):
-        # Return Sunday=1 through Saturday=7.
-        days = {"1": 6, "2": 0, "3": 1, "4": 2, "5": 3, "6": 4, "7": 5}
-        return days.get(day_number)
-
-    def _get_month_payments(self, user, current_year, query, category=None):
-        """ Return month payments for a year from a request
-        :arg user object
-        :type user: User
-        :arg category: A category to filter through
-        :type category: string
-        :returns: A list with the amounts in income for every month
+    month_labels = [
+        "January",
+        "February",
+        "March",
+        "April",
+        "May",
+        "June",
+        "July",
+        "August",
+        "September",
+        "October",
+        "November",
+        "December",
+    ]
+    week_labels = [
+        "Monday",
+        "Tuesday",
+        "Wednesday",
+        "Thursday",
+        "Friday",
+        "Saterday",
+        "Sunday",
+    ]
+
+    def _income_rows(self, vendor, year):
+        """ Return the daily income rows of a vendor for a year
+        :arg vendor object
+        :type vendor: Vendor
+        :arg year: The year of the income
+        :type year: int
+        :returns: (category, day, amount) for every day with income
         :rtype: list
 
+        The rows are cached until the income of the vendor changes so browsing
+        through periods doesn't query the roll up again.
         """
-        data = (
-            query.annotate(month=ExtractMonth("created__day"))
-            .values("month")
-            .annotate(
-                amount=Sum("payment__amount"),
-                category=F("payment__order__product__categories__name"),
+        version = vendor_cache_version(vendor.pk, "income")
+        key = "income_tracker:%s:%s:%s" % (vendor.pk, year, version)
+        rows = cache.get(key)
+        if rows is None:
+            rows = list(
+                DailyIncome.objects.filter(vendor=vendor, day__year=year)
+                .order_by("category")
+                .values_list("category", "day", "amount")
             )
+            cache.set(key, rows, 60 * 60)
+        return rows
+
+    def _month_income(self, rows):
+        month_payments: dict = defaultdict(lambda: [Decimal(0)] * 12)
+        for category, day, amount in rows:
+            month_payments[category][day.month - 1] += amount
+        return month_payments
+
+    def _week_income(self, rows, start_week, end_week):
+        week_payments: dict = defaultdict(lambda: [Decimal(0)] * 7)
+        for category, day, amount in rows:
+            if start_week <= day <= end_week:
+                week_payments[category][day.weekday()] += amount
+        return week_payments
+
+    def _month_total(self, month_payments, start_month, end_month):
+        return sum(
+            sum(values[start_month - 1 : end_month])
+            for values in month_payments.values()
         )
-        group_by_value: dict = defaultdict(list)
-        for value in data:
-            if (
-                group_by_value is not None
-                and len(group_by_value[value.get("category")]) == 0
-            ):
-                group_by_value[value.get("category")] = [
-                    0,
-                    0,
-                    0,
-                    0,
-                    0,
-                    0,
-                    0,
-                    0,
-                    0,
-                    0,
-                    0,
-                    0,
-                ]
-            group_by_value[value.get("category")][value.get("month") - 1] = value.get(
-                "amount"
-            )
-        return group_by_value
-
-    def _get_week_payments(
-        self, user, current_year, query, start_week, end_week, category=None
-    ):
-        """ Return week payments for a year
-        :arg user object
-        :type user: User
-        :arg category: A category to filter through
-        :type category: string
-        :returns: A list with the amounts in income for every month
-        :rtype: list
 
-        """
-        data = (
-            query.filter(created__range=[start_week, end_week])
-            .annotate(day=ExtractWeekDay("created__day"))
-            .values("day")
-            .annotate(
-                amount=Sum("payment__amount"),
-                category=F("payment__order__product__categories__name"),
-            )
-        )
-        group_by_value: dict = defaultdict(list)
-        for value in data:
-            if (
-                group_by_value is not None
-                and len(group_by_value[value.get("category")]) == 0
-            ):
-                group_by_value[value.get("category")] = [0, 0, 0, 0, 0, 0, 0]
-            day_number = self._get_correct_day(str(value.get("day")))
-            group_by_value[value.get("category")][day_number] = value.get("amount")
-        return group_by_value
-
-    def _datasets(
-        self,
-        request,
-        categories,
-        query,
-        data_type="month",
-        start_week=None,
-        end_week=None,
-    ):
+    def _period(self, request):
+        """ Year, month range and week of the request, defaults to the current week """
+        today = datetime.date.today()
+        params = request.query_params
+        year = int(params.get("year", today.year))
+        start_month = int(params.get("start_month", 1))
+        end_month = int(params.get("end_month", 12))
+        if not 1 <= start_month <= end_month <= 12:
+            raise ValueError("Invalid month range")
+        if params.get("week"):
+            start_week = datetime.date.fromisocalendar(year, int(params.get("week")), 1)
+        elif year == today.year:
+            start_week = today - datetime.timedelta(today.weekday())
+        else:
+            last_week = datetime.date(year, 12, 28).isocalendar()[1]
+            start_week = datetime.date.fromisocalendar(year, last_week, 1)
+        return year, start_month, end_month, start_week
+
+    def _progress(self, category, amount, total, **extra):
+        percentage = round(amount / total * 100, 2) if total else Decimal(0)
+        return dict(extra, label=category, amount=amount, percentage=percentage)
+
+    def _datasets(self, month_payments, week_payments, start_month=1, end_month=12):
         week_datasets = []
         month_datasets = []
-        current_year = (
-            datetime.date.today().year
-        )  # TODO In future needs to make it variable
-        month_labels = [
-            "January",
-            "February",
-            "March",
-            "April",
-            "May",
-            "June",
-            "July",
-            "August",
-            "September",
-            "October",
-            "November",
-            "December",
-        ]
-        week_labels = [
-            "Monday",
-            "Tuesday",
-            "Wednesday",
-            "Thursday",
-            "Friday",
-            "Saterday",
-            "Sunday",
-        ]
-        month_payments_data = self._get_month_payments(
-            request.user, current_year, query, category=None
-        )
-        week_payments_data = self._get_week_payments(
-            request.user,
-            current_year,
-            query,
-            category=None,
-            start_week=start_week,
-            end_week=end_week,
-        )
         category_count_week = 0
         category_count_month = 0
-        for category, values in week_payments_data.items():
+        for category, values in week_payments.items():
+            if not any(values):
+                continue
             category_count_week = category_count_week + 1
             line_data = self._line_chart(
                 values=values, label=category, category_count=category_count_week
             )
             week_datasets.append(line_data)
 
-        for category, values in month_payments_data.items():
+        for category, values in month_payments.items():
             category_count_month = category_count_month + 1
             line_data = self._line_chart(
-                values=values, label=category, category_count=category_count_month
+                values=values[start_month - 1 : end_month],
+                label=category,
+                category_count=category_count_month,
             )
             month_datasets.append(line_data)
 
         income_data = {
             "income_data": {
-                "week": {
-                    "labels": week_labels if week_labels else [],
-                    "datasets": week_datasets if week_datasets else [],
-                },
+                "week": {"labels": self.week_labels, "datasets": week_datasets},
                 "month": {
-                    "labels": month_labels if month_labels else [],
-                    "datasets": month_datasets if month_datasets else [],
+                    "labels": self.month_labels[start_month - 1 : end_month],
+                    "datasets": month_datasets,
                 },
             }
         }
         return income_data
 
+    @vendor_response_cache()
     def get(self, request, pk=None, format=None, data_type="month"):
-
-        date = datetime.date.today()
-        start_week = date - datetime.timedelta(date.weekday())
-        end_week = start_week + datetime.timedelta(7)
-        user = request.user
-        categories = (
-            user.vendor.products.annotate(category=F("categories__name"))
-            .values_list("category", flat=True)
-            .order_by("categories__name")
-        )
-
-        query = (
-            user.vendor.transactions.only(
-                "id", "payment__amount", "payment", "created"
-            )
-            .filter(
-                created__year=datetime.date.today().year,
-                payment__isnull=False,
-                payment__amount__gte=0,
-                payment__order__status="completed"
-            )
-            .order_by("payment__order__product__categories__name")
-        )
-
-        totals = query.aggregate(
-            # day_total_earned=Sum("payment__amount", filters=Q(created=datetime.date.today())),
-            week_total_earned=Sum(
-                "payment__amount", filter=Q(created__range=[start_week, end_week])
-            ),
-            # month_total_earned=Sum("payment__amount", filters=Q(created=datetime.date.today().month)),
-            total_earned=Sum("payment__amount"),
-        )
-
-        amount = DecimalFunc(F("payment__amount"))
-
-        # # prevent divison by zero
-        if totals.get("total_earned") != 0:
-            month_expresion = ExpressionWrapper(
-                amount / totals.get("total_earned") * 100, output_field=DecimalField()
-            )
-        else:
-            month_expresion = ExpressionWrapper(amount, output_field=DecimalField())
-
-        if totals.get("total_earned") != 0:
-            week_expresion = ExpressionWrapper(
-                amount / Value(totals.get("week_total_earned")) * 100,
-                output_field=DecimalField(),
-            )
-        else:
-            week_expresion = ExpressionWrapper(amount, output_field=DecimalField())
-
-        month_progress_query = (
-            query.annotate(month=ExtractMonth("created__day"))
-            .values("month")
-            .annotate(
-                amount=Sum("payment__amount"),
-                percentage=RoundFunc(Sum(month_expresion), 2),
-                label=F("payment__order__product__categories__name"),
-            )
-        )
-        week_progress_query = (
-            query.filter(created__date__range=[start_week, end_week])
-            .annotate(week=ExtractWeek("created__week"))
-            .values("week")
-            .annotate(
-                amount=Sum("payment__amount"),
-                percentage=RoundFunc(Sum(week_expresion), 2),
-                label=F("payment__order__product__categories__name"),
-            )
-        )
+        try:
+            year, start_month, end_month, start_week = self._period(request)
+        except ValueError:
+            return Response(data={"error": "Invalid period."}, status=400)
+        end_week = start_week + datetime.timedelta(6)
+        vendor = request.user.vendor
+        month_payments = self._month_income(self._income_rows(vendor, year))
+        week_rows = self._income_rows(vendor, start_week.year)
+        if end_week.year != start_week.year:
+            week_rows = week_rows + self._income_rows(vendor, end_week.year)
+        week_payments = self._week_income(week_rows, start_week, end_week)
+
+        total_earned = self._month_total(month_payments, start_month, end_month)
+        week_total_earned = sum(sum(values) for values in week_payments.values())
+        progress_month_list = []
+        for category, values in month_payments.items():
+            for month in range(start_month, end_month + 1):
+                if values[month - 1]:
+                    progress_month_list.append(
+                        self._progress(
+                            category, values[month - 1], total_earned, month=month
+                        )
+                    )
+        progress_week_list = []
+        week = start_week.isocalendar()[1]
+        for category, values in week_payments.items():
+            if any(values):
+                progress_week_list.append(
+                    self._progress(category, sum(values), week_total_earned, week=week)
+                )
 
         progress_count = 0
-        progress_week = None
-        progress_month = None
-        progress_week_list = []
-        progress_month_list = []
         for progress_week, progress_month in itertools.zip_longest(
-            week_progress_query, month_progress_query
+            progress_week_list, progress_month_list
         ):
             progress_count = progress_count + 1
             if progress_week:
                 progress_week.update({"color": color_list[progress_count]})
-                progress_week_list.append(progress_week)
             if progress_month:
                 progress_month.update({"color": color_list[progress_count]})
-                progress_month_list.append(progress_month)
         progress_data = {
             "progress_bar_data": {
                 "week": progress_week_list,
@@ -375,141 +319,258 @@ class IncomeTrackerApiView(APIView):
             }
         }
 
-        data = self._datasets(
-            request,
-            categories,
-            query=query,
-            data_type=data_type,
-            start_week=start_week,
-            end_week=end_week,
-        )
+        data = self._datasets(month_payments, week_payments, start_month, end_month)
         data.update(progress_data)
+        data.update(
+            {
+                "period": {
+                    "year": year,
+                    "start_month": start_month,
+                    "end_month": end_month,
+                    "week": week,
+                    "start_week": start_week,
+                    "end_week": end_week,
+                },
+                "total_earned": total_earned,
+                "week_total_earned": week_total_earned,
+            }
+        )
+        if request.query_params.get("compare") in ("1", "true", "previous_year"):
+            data["comparison"] = self._comparison(
+                vendor, year - 1, start_month, end_month, total_earned
+            )
         return Response(data, status=200)
 
+    def _comparison(self, vendor, year, start_month, end_month, total_earned):
+        """ The same month range in another year ( year over year ) """
+        month_payments = self._month_income(self._income_rows(vendor, year))
+        compare_total = self._month_total(month_payments, start_month, end_month)
+        datasets = self._datasets(month_payments, {}, start_month, end_month)
+        change = None
+        if compare_total:
+            change = round((total_earned - compare_total) / compare_total * 100, 2)
+        return {
+            "year": year,
+            "month": datasets["income_data"]["month"],
+            "total_earned": compare_total,
+            "change_percentage": change,
+        }
+
+
+class QueryCounter:
+    """ Count the queries executed while it is installed on the connection """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
 
 class MainDashboardApiView(APIView):
+    """
+    The scalar metrics come from one conditional aggregation over the
+    transactions and one query with count subqueries, the top 5 lists take
+    one query each on the request connection. The query count and duration are sent in the
+    ``X-Query-Count`` and ``Server-Timing`` headers.
+    """
+
+    def _metrics(self, vendor):
+        payments = Q(payment__isnull=False, payout__isnull=True)
+        completed = payments & Q(payment__order__status="completed")
+        metrics = vendor.transactions.aggregate(
+            total_orders=Count("payment__order", distinct=True),
+            total_payments=Count("id", filter=payments),
+            earned_today=Coalesce(
+                Sum(
+                    "payment__amount",
+                    filter=completed & Q(created__date=datetime.date.today()),
+                ),
+                0,
+            ),
+            total_earned=Coalesce(Sum("payment__amount", filter=completed), 0),
+            total_payout=Count(
+                "id", filter=Q(payment__isnull=True, payout__isnull=False)
+            ),
+        )
+
+        def count(queryset, vendor_field):
+            return Coalesce(
+                Subquery(
+                    queryset.order_by()
+                    .values(vendor_field)
+                    .annotate(total=Count("pk"))
+                    .values("total")
+                ),
+                0,
+            )
+
+        metrics.update(
+            Vendor.objects.filter(pk=vendor.pk)
+            .annotate(
+                total_products=count(
+                    Product.objects.filter(vendor=OuterRef("pk")), "vendor"
+                ),
+                total_reviews=count(
+                    ProductReview.objects.filter(product__vendor=OuterRef("pk")),
+                    "product__vendor",
+                ),
+                total_disputes=count(
+                    Dispute.objects.filter(vendor=OuterRef("pk")), "vendor"
+                ),
+            )
+            .values("total_products", "total_reviews", "total_disputes")
+            .get()
+        )
+        return metrics
+
+    @vendor_response_cache()
     def get(self, request, pk=None, format=None):
+        start = time.perf_counter()
         user = request.user
-        orders = (
-            Order.objects.filter(payment__transaction__vendor__user=user)
-            .annotate(product_name=F("product__title"))
-            .order_by("id")
-            .values(
-                "id", "product_name", "status", "created", amount=F("payment__amount")
+        vendor = user.vendor
+        counter = QueryCounter()
+        lists = {
+            "orders": lambda: list(
+                Order.objects.filter(payment__transaction__vendor=vendor)
+                .annotate(product_name=F("product__title"))
+                .order_by("id")
+                .values(
+                    "id",
+                    "product_name",
+                    "status",
+                    "created",
+                    amount=F("payment__amount"),
+                )[:5]
+            ),
+            "reviews": lambda: list(
+                ProductReview.objects.filter(product__vendor=vendor).order_by("id")[:5]
+            ),
+            "disputes": lambda: list(
+                Dispute.objects.filter(vendor=vendor).order_by("id")[:5]
+            ),
+        }
+        with connection.execute_wrapper(counter):
+            data = self._metrics(vendor)
+            data.update({name: query() for name, query in lists.items()})
+            serializer = MainDashboardSerializer(
+                data, context={"request": self.request}
             )
-        )
-        reviews = ProductReview.objects.filter(
-            product__vendor__user=user
-        ).order_by("id")[:5]
-        disputes = Dispute.objects.filter(vendor__user=user,)[:5]
-        total_products = Product.objects.filter(vendor__user=user).count()
-        payments = user.vendor.transactions.values(
-            "payment", "created", "payment__order__status"
-        ).filter(payment__isnull=False, payout__isnull=True)
-
-        earned_today = payments.filter(
-            created__startswith=datetime.date.today(),
-            payment__order__status="completed"
-        ).aggregate(earned_today=Coalesce(Sum("payment__amount"), 0))
-        total_earned = payments.filter(
-            payment__order__status="completed"
-        ).aggregate(
-            total_earned=Coalesce(Sum("payment__amount"), 0)
-        )
-        disputes = Dispute.objects.filter(vendor=user.vendor)
-        total_payout = (
-            user.vendor.transactions.values("payout")
-            .filter(payment__isnull=True, payout__isnull=False)
-        )
-        serializer = MainDashboardSerializer(
-            {
-                "orders": orders[:5],
-                "reviews": reviews,
-                "disputes": disputes,
-                "earned_today": earned_today.get("earned_today"),
-                "total_products": total_products,
-                "total_orders": orders.count(),
-                "total_earned": total_earned.get("total_earned"),
-                "total_payments": payments.count(),
-                "total_disputes": disputes.count(),
-                "total_reviews": reviews.count(),
-                "total_payout": total_payout.count(),
+            response_data = serializer.data
+        duration = (time.perf_counter() - start) * 1000
+        return Response(
+            response_data,
+            headers={
+                "X-Query-Count": str(counter.count),
+                "Server-Timing": "total;dur=%.1f" % duration,
             },
-            context={"request": self.request},
         )
-        if serializer:
-            return Response(serializer.data)
-        return Response(data={"error": "Something went wrong."})
 
 
 class DashboardBalanceApiView(APIView):
+    """
+    Balance of the vendor with the first page of its operations and invoices,
+    the full history is in ``DashboardOperationsApiView`` and
+    ``DashboardInvoicesApiView``.
+    """
+
+    preview_size = 10
+
+    @vendor_response_cache()
     def get(self, request, pk=None, format=None):
-        user = request.user
-        pending = Payment.objects.filter(
-            transaction__vendor=user.vendor,
-            status="pending",
-            order__status=Order.PENDING,
+        vendor = request.user.vendor
+        # Withdrawals are checked against the ledger, so the numbers shown are
+        # read from it as well. A vendor without a ledger row has nothing yet
+        ledger_balance = LedgerBalance.objects.filter(
+            vendor=vendor
+        ).first() or LedgerBalance(vendor=vendor)
+        operations = VendorOperation.objects.filter(vendor=vendor).order_by(
+            "-created", "-id"
         )
-        if user and user.vendor.balance:
-            available_payout = user.vendor.balance.available_payout
-            last_payout = Payout.objects.filter(
-                transaction__vendor=user.vendor, status="omw"
-            ).last()
-            invoices = Payment.objects.filter(transaction__vendor=user.vendor).values(
-                "status", "amount", product_name=F("order__product__title")
-            )
-            transactions = (
-                Transaction.objects.filter(vendor=user.vendor)
-                .annotate(
-                    day=ExtractDay("created"),
-                    month=ExtractMonth("created"),
-                    type=F("_type"),
-                    amount=Case(
-                        When(payment__amount__gte=0, then=F("payment__amount")),
-                        When(payout__amount__gte=0, then=F("payout__amount")),
-                        default=Value(0),
-                        output_field=DecimalField(),
-                    ),
-                    _from=Case(
-                        When(payment__isnull=False, then=Value("From customer")),
-                        When(payout__isnull=False, then=Value("From application")),
-                        default=None,
-                        output_field=CharField(),
-                    ),
-                    currency=Case(
-                        When(payment=True, then=Value("USD")),
-                        When(payout=True, then=Value("USD")),
-                        default=Value("USD"),
-                        output_field=CharField(),
-                    ),
-                )
-                .values("day", "month", "type", "amount", "_from", "currency")
-            )
-            transaction_data = TransactionOperationSerializer(transactions[:10], many=True)
-            invoice_data = TransactionInvoiceSerializer(invoices[:10], many=True)
-            return Response(
-                data={
-                    "balance": user.vendor.balance.available,
-                    "available_payout": available_payout,
-                    "pending": pending.aggregate(amount=Sum("amount")).get("amount"),
-                    "last_payout": last_payout.amount if last_payout else None,
-                    "operations": transaction_data.data,
-                    "invoices": invoice_data.data,
-                }
-            )
-        else:
-            return Response(data=None)
+        last_payout = operations.filter(
+            source=VendorOperation.PAYOUT, status=Payout.OMW
+        ).first()
+        invoices = operations.filter(source=VendorOperation.PAYMENT)
+        transaction_data = serializers.VendorOperationSerializer(
+            operations[: self.preview_size], many=True
+        )
+        invoice_data = serializers.VendorInvoiceSerializer(
+            invoices[: self.preview_size], many=True
+        )
+        return Response(
+            data={
+                "balance": ledger_balance.available,
+                "available_payout": ledger_balance.available - ledger_balance.reserved,
+                "pending": ledger_balance.pending,
+                "paid_out": ledger_balance.paid_out,
+                "last_payout": last_payout.amount if last_payout else None,
+                "operations": transaction_data.data,
+                "invoices": invoice_data.data,
+            }
+        )
+
+
+class DashboardOperationsApiView(generics.ListAPIView):
+    """ Every operation of the vendor, newest first, cursor paginated """
+
+    serializer_class = serializers.VendorOperationSerializer
+    pagination_class = OperationCursorPagination
+
+    def get_queryset(self):
+        return VendorOperation.objects.filter(vendor=self.request.user.vendor).order_by(
+            "-created", "-id"
+        )
+
+
+class DashboardInvoicesApiView(DashboardOperationsApiView):
+    """ Every payment of a customer to the vendor, newest first, cursor paginated """
+
+    serializer_class = serializers.VendorInvoiceSerializer
+
+    def get_queryset(self):
+        return super().get_queryset().filter(source=VendorOperation.PAYMENT)
 
 
 class BankWithdrawApiView(APIView):
+    """
+    Queue a payout of the vendor, answers 202 with the job right away. The
+    outcome is polled from ``PayoutJobApiView``.
+    """
+
     def post(self, request, pk=None, format=None):
         user = request.user
-        vendor_balance_withdraw = VendorBalanceWithdraw(user)
         serializer = WithdrawSerializer(data=request.data)
         if serializer.is_valid():
-            response = vendor_balance_withdraw.create_payout(
-                amount=serializer.data.get("amount")
+            job = submit_payout_job(user.vendor, serializer.data.get("amount"))
+            return Response(
+                data={"job_id": job.pk, "status": job.status}, status=202
             )
-            return Response(data=response)
         else:
             return Response(data={"message": "Something went wrong"}, status=400)
+
+
+class PayoutJobApiView(generics.RetrieveAPIView):
+    serializer_class = serializers.PayoutJobSerializer
+
+    def get_queryset(self):
+        return PayoutJob.objects.filter(vendor=self.request.user.vendor)
+
+
+class StripeWebhookApiView(APIView):
+    """
+    Receiver of the Stripe webhooks. The event is only verified and stored,
+    Stripe gets its answer before the event is processed.
+    """
+
+    authentication_classes = []
+    permission_classes = (permissions.AllowAny,)
+
+    def post(self, request, format=None):
+        event = stripe_construct_event(
+            request.body, request.META.get("HTTP_STRIPE_SIGNATURE")
+        )
+        if event is None:
+            return Response(data={"message": "Invalid signature"}, status=400)
+        stripe_ingest_event(event)
+        return Response(status=200)
@@ -0,0 +1,17 @@
+from importlib import import_module
+
+from django.apps import AppConfig
+
+
+class MarketplaceConfig(AppConfig):
+    name = "snap.apps.marketplace"
+    label = "marketplace"
+
+    def import_models(self):
+        super().import_models()
+        # The ledger, payout job and webhook models live next to the Stripe code
+        import_module("%s.payment_models" % self.name)
+
+    def ready(self):
+        # Connect the receivers that keep summaries, rollups and caches up to date
+        from snap.apps.marketplace import signals  # noqa: F401
@@ -0,0 +1,108 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from django.core.cache import cache
+from django.db import connection
+from rest_framework.response import Response
+
+refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cache-refresh")
+
+
+def _version_key(vendor_id, scope):
+    return "vendor:%s:%s:version" % (vendor_id, scope)
+
+
+def vendor_cache_version(vendor_id, scope):
+    """ Current version of the cached data of a vendor, part of every cache key """
+    return cache.get_or_set(_version_key(vendor_id, scope), 1, None)
+
+
+def bump_vendor_cache_version(vendor_id, scope):
+    """ Invalidate all cached data of a vendor in a scope by moving to a new version """
+    try:
+        return cache.incr(_version_key(vendor_id, scope))
+    except ValueError:
+        cache.set(_version_key(vendor_id, scope), 2, None)
+        return 2
+
+
+# Headers that describe the computation of one response, a cached copy would
+# report the numbers of the request that filled the cache
+REQUEST_HEADERS = ("X-Query-Count", "Server-Timing")
+
+
+def vendor_response_cache(
+    scope="dashboard", fresh_for=60, max_stale=60 * 15, timeout=60 * 60 * 24
+):
+    """
+    Cache the GET response of a vendor dashboard view.
+
+    Every entry remembers the vendor version it was computed for. A fresh entry
+    of the current version is returned as is. A stale entry, older than
+    ``fresh_for`` seconds or of an older version, is still returned right away
+    while a background thread computes the new response ( stale while
+    revalidate ). Without an entry, or with one older than ``max_stale``
+    seconds, the response is computed in the request.
+    """
+
+    def decorator(get):
+        def refresh(key, version, view, request, *args, **kwargs):
+            response = get(view, request, *args, **kwargs)
+            if response.status_code == 200:
+                entry = {
+                    "version": version,
+                    "created": time.time(),
+                    "data": response.data,
+                    "status": response.status_code,
+                    "headers": {
+                        name: value
+                        for name, value in response.items()
+                        if name not in REQUEST_HEADERS
+                    },
+                }
+                cache.set(key, entry, timeout)
+            return response
+
+        def refresh_in_background(key, *args, **kwargs):
+            try:
+                refresh(key, *args, **kwargs)
+            finally:
+                cache.delete("%s:refreshing" % key)
+                connection.close()
+
+        @wraps(get)
+        def wrapper(view, request, *args, **kwargs):
+            vendor_id = request.user.vendor.pk
+            version = vendor_cache_version(vendor_id, scope)
+            key = "%s:%s:%s:%s" % (
+                scope,
+                view.__class__.__name__,
+                vendor_id,
+                request.get_full_path(),
+            )
+            entry = cache.get(key)
+            if entry is None or time.time() - entry["created"] > max_stale:
+                return refresh(key, version, view, request, *args, **kwargs)
+            if (
+                entry["version"] != version
+                or time.time() - entry["created"] > fresh_for
+            ):
+                # Only one refresh per entry at the same time
+                if cache.add("%s:refreshing" % key, True, 30):
+                    refresh_executor.submit(
+                        refresh_in_background,
+                        key,
+                        version,
+                        view,
+                        request,
+                        *args,
+                        **kwargs,
+                    )
+            return Response(
+                entry["data"], status=entry["status"], headers=entry["headers"]
+            )
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from snap.apps.marketplace.models import Payment, Payout
+from snap.apps.marketplace.payment_models import LedgerEntry
+
+
+class Command(BaseCommand):
+    help = "Record the payments and payouts of every vendor in the ledger"
+
+    def handle(self, *args, **options):
+        # Entries are unique per kind and payment or payout, the same as the
+        # signals write, so running this again or after the signals is a no-op
+        payments = (
+            Payment.objects.filter(transaction__vendor__isnull=False)
+            .select_related("order")
+            .distinct()
+        )
+        payment_count = 0
+        for payment in payments.iterator():
+            LedgerEntry.sync_payment(payment)
+            payment_count += 1
+
+        payouts = Payout.objects.filter(transaction__vendor__isnull=False).annotate(
+            ledger_vendor_id=F("transaction__vendor_id")
+        )
+        payout_count = 0
+        for payout in payouts.iterator():
+            # Payouts that failed right away used to be stored as on their way,
+            # their Stripe response still carries the failure code
+            failed = payout.status == Payout.FAILED or (payout.data or {}).get(
+                "failure_code"
+            ) not in (None, "null")
+            if failed:
+                LedgerEntry.reverse_payout(payout.ledger_vendor_id, payout)
+            else:
+                LedgerEntry.record_payout(payout.ledger_vendor_id, payout)
+            payout_count += 1
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Synced {payment_count} payments and {payout_count} payouts"
+            )
+        )
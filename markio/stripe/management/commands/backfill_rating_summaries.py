@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from snap.apps.catalogue.models import ProductRatingSummary
+
+
+class Command(BaseCommand):
+    help = "Rebuild the review rating summary of every product"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--product", type=int, nargs="*", help="Only rebuild these product ids"
+        )
+
+    def handle(self, *args, **options):
+        count = ProductRatingSummary.rebuild(product_ids=options.get("product"))
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {count} rating summaries"))
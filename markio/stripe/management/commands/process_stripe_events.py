@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from snap.apps.marketplace.stripe import stripe_process_pending_events
+
+
+class Command(BaseCommand):
+    help = "Process the stored Stripe webhook events in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once", action="store_true", help="Stop when no events are pending"
+        )
+        parser.add_argument(
+            "--batch", type=int, default=100, help="Events processed at a time"
+        )
+        parser.add_argument(
+            "--sleep", type=float, default=2, help="Seconds to wait without events"
+        )
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            count = stripe_process_pending_events(limit=options["batch"])
+            total += count
+            if count:
+                continue
+            if options["once"]:
+                break
+            connection.close()
+            time.sleep(options["sleep"])
+        self.stdout.write(self.style.SUCCESS(f"Processed {total} Stripe events"))
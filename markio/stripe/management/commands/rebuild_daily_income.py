@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from snap.apps.catalogue.models import DailyIncome
+
+
+class Command(BaseCommand):
+    help = "Roll up the daily income of every vendor again"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--vendor", type=int, nargs="*", help="Only rebuild these vendor ids"
+        )
+
+    def handle(self, *args, **options):
+        count = DailyIncome.rebuild(vendor_ids=options.get("vendor"))
+        self.stdout.write(self.style.SUCCESS(f"Rolled up {count} daily incomes"))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from snap.apps.catalogue.models import Product, ProductSearchDocument
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full text search document of every product"
+
+    def handle(self, *args, **options):
+        count = 0
+        for product in Product.objects.iterator(chunk_size=500):
+            ProductSearchDocument.index_product(product)
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} products"))
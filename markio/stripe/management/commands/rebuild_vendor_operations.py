@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from snap.apps.marketplace.payment_models import VendorOperation
+
+
+class Command(BaseCommand):
+    help = "Write the balance operations of every vendor again"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--vendor", type=int, nargs="*", help="Only rebuild these vendor ids"
+        )
+
+    def handle(self, *args, **options):
+        count = VendorOperation.rebuild(vendor_ids=options.get("vendor"))
+        self.stdout.write(self.style.SUCCESS(f"Wrote {count} operations"))
@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from snap.apps.vendor.utils import process_payout_jobs
+
+
+class Command(BaseCommand):
+    help = "Run queued payout jobs, several workers can run at the same time"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once", action="store_true", help="Stop when the queue is empty"
+        )
+        parser.add_argument(
+            "--batch", type=int, default=10, help="Jobs run before the queue is checked again"
+        )
+        parser.add_argument(
+            "--sleep", type=float, default=2, help="Seconds to wait on an empty queue"
+        )
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            count = process_payout_jobs(limit=options["batch"])
+            total += count
+            if count:
+                continue
+            if options["once"]:
+                break
+            connection.close()
+            time.sleep(options["sleep"])
+        self.stdout.write(self.style.SUCCESS(f"Ran {total} payout jobs"))
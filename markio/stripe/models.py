@@ -1,12 +1,15 @@
 @property
 def to_dict(self):
     """ Turn Product to dict variables"""
+    return self.to_variant_dict()
+
+def to_variant_dict(self, attributes=None):
+    """ Turn Product to dict variables, pass attributes when they are already loaded """
     obj_dict = {}
-    strategy = Selector().strategy()
-    info = strategy.fetch_for_product(self)
     for attribute in self.__dict__:
         if not hasattr(attribute, "attr") and attribute not in [
             "_state",
+            "_prefetched_objects_cache",
             "structure",
             "is_public",
             "product_class_id",
@@ -19,13 +22,17 @@ def to_dict(self):
         ]:
             obj_dict.update({attribute: getattr(self, attribute)})
         if attribute == "attr":
-            attrs = (
-                self.attributes.all()
-                .annotate(value=F("productattributevalue__value_option__option"))
-                .values("code", "name", "value")
-            )
+            if attributes is None:
+                attributes = (
+                    self.attribute_values.annotate(
+                        name=F("attribute__name"),
+                        code=F("attribute__code"),
+                        value=F("value_option__option"),
+                    )
+                    .values("code", "name", "value")
+                )
             attr_list = []
-            for attr in attrs:
+            for attr in attributes:
                 attr_list.append(
                     {
                         "name": attr.get("name"),
@@ -34,9 +41,60 @@ def to_dict(self):
                     }
                 )
             obj_dict.update({"attributes": attr_list})
-    # obj_dict.update({"price": info.price})
     return obj_dict
 
+STRIPE_METADATA_MAX_KEYS = 50
+STRIPE_METADATA_KEY_LENGTH = 40
+STRIPE_METADATA_VALUE_LENGTH = 500
+STRIPE_METADATA_CACHE_KEY = "product:stripe_metadata:%s"
+
+def build_stripe_metadata(self):
+    """ Compact metadata snapshot of the product within Stripe's metadata limits """
+    metadata = {
+        "product_id": self.pk,
+        "title": self.title,
+        "slug": self.slug,
+        "upc": self.upc,
+        "vendor_id": self.vendor_id,
+        "parent_id": self.parent_id,
+    }
+    attributes = (
+        self.attribute_values.annotate(
+            value=Coalesce("value_option__option", "value_text")
+        )
+        .order_by("attribute__code")
+        .values_list("attribute__code", "value")
+    )
+    for code, value in attributes:
+        metadata["attr_%s" % code] = value
+    trimmed = {}
+    for key, value in metadata.items():
+        if value is None or value == "":
+            continue
+        if len(trimmed) == STRIPE_METADATA_MAX_KEYS:
+            break
+        short_key = key[:STRIPE_METADATA_KEY_LENGTH]
+        if short_key in trimmed:
+            # Long attribute codes can start the same, keep them apart with a
+            # hash of the full key
+            digest = hashlib.sha1(key.encode()).hexdigest()[:8]
+            short_key = short_key[: STRIPE_METADATA_KEY_LENGTH - len(digest)] + digest
+        trimmed[short_key] = str(value)[:STRIPE_METADATA_VALUE_LENGTH]
+    return trimmed
+
+def refresh_stripe_metadata(self):
+    metadata = self.build_stripe_metadata()
+    cache.set(STRIPE_METADATA_CACHE_KEY % self.pk, metadata, None)
+    return metadata
+
+@property
+def stripe_metadata(self):
+    """ Metadata sent with the checkout, stored when the product or an attribute is saved """
+    metadata = cache.get(STRIPE_METADATA_CACHE_KEY % self.pk)
+    if metadata is None:
+        metadata = self.refresh_stripe_metadata()
+    return metadata
+
 @property
 def stockrecord(self):
     return self.stockrecords.first()
@@ -52,3 +110,266 @@ def to_line_item(self):
 @cached_property
 def cached_reviews(self):
     return self.reviews
+
+
+class ProductRatingSummary(models.Model):
+    """
+    Review scores of a product, kept up to date when a review is created, edited
+    or deleted so product endpoints don't have to aggregate the reviews.
+    """
+
+    product = models.OneToOneField(
+        "catalogue.Product", related_name="rating_summary", on_delete=models.CASCADE
+    )
+    score_1 = models.PositiveIntegerField(default=0)
+    score_2 = models.PositiveIntegerField(default=0)
+    score_3 = models.PositiveIntegerField(default=0)
+    score_4 = models.PositiveIntegerField(default=0)
+    score_5 = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(default=0)
+    score_sum = models.PositiveIntegerField(default=0)
+    top_review = models.ForeignKey(
+        "reviews.ProductReview",
+        null=True,
+        blank=True,
+        related_name="+",
+        on_delete=models.SET_NULL,
+    )
+
+    SCORES = range(1, 6)
+
+    @property
+    def counts(self):
+        return {score: getattr(self, "score_%s" % score) for score in self.SCORES}
+
+    @property
+    def average(self):
+        if self.total:
+            return round(self.score_sum / self.total, 2)
+        return None
+
+    @classmethod
+    def for_product(cls, product_id):
+        """ Summary of the product, counted from its reviews when it has none yet """
+        summary = cls.objects.filter(product_id=product_id).first()
+        if summary is None:
+            cls.rebuild(product_ids=[product_id])
+            summary = cls.objects.filter(product_id=product_id).first()
+        return summary
+
+    @classmethod
+    def apply_review(cls, product_id, score=None, old_score=None):
+        """ Count a new score and/or remove an old one with a single UPDATE """
+        summary = cls.objects.filter(product_id=product_id).first()
+        if summary is None:
+            if score is None:
+                # Don't create a summary while the product itself is being deleted
+                return None
+            # The saved review is already counted by the rebuild
+            return cls.for_product(product_id)
+        deltas = defaultdict(int)
+        if old_score is not None:
+            deltas["total"] -= 1
+            deltas["score_sum"] -= old_score
+            if old_score in cls.SCORES:
+                deltas["score_%s" % old_score] -= 1
+        if score is not None:
+            deltas["total"] += 1
+            deltas["score_sum"] += score
+            if score in cls.SCORES:
+                deltas["score_%s" % score] += 1
+        updates = {field: F(field) + delta for field, delta in deltas.items() if delta}
+        if updates:
+            cls.objects.filter(pk=summary.pk).update(**updates)
+        return summary
+
+    def refresh_top_review(self):
+        self.top_review = self.product.reviews.order_by("-delta_votes").first()
+        self.save(update_fields=["top_review"])
+
+    @classmethod
+    def rebuild(cls, product_ids=None):
+        """ Recount the summaries from the reviews, used to backfill """
+        reviews = ProductReview.objects.all()
+        if product_ids is not None:
+            reviews = reviews.filter(product_id__in=product_ids)
+        summaries = {}
+        for row in reviews.values("product_id", "score").annotate(count=Count("id")):
+            summary = summaries.setdefault(
+                row["product_id"], cls(product_id=row["product_id"])
+            )
+            summary.total += row["count"]
+            summary.score_sum += row["score"] * row["count"]
+            if row["score"] in cls.SCORES:
+                setattr(summary, "score_%s" % row["score"], row["count"])
+        top_reviews = reviews.order_by("product_id", "-delta_votes").distinct(
+            "product_id"
+        )
+        for product_id, review_id in top_reviews.values_list("product_id", "id"):
+            summaries[product_id].top_review_id = review_id
+        with transaction.atomic():
+            stale = cls.objects.all()
+            if product_ids is not None:
+                stale = stale.filter(product_id__in=product_ids)
+            stale.delete()
+            cls.objects.bulk_create(summaries.values(), batch_size=500)
+        return len(summaries)
+
+
+class ProductSearchDocument(models.Model):
+    """
+    Full text search vector over the title, description and attribute values of a
+    product. Kept up to date when the product or one of its attributes is saved.
+    """
+
+    product = models.OneToOneField(
+        "catalogue.Product",
+        primary_key=True,
+        related_name="search_document",
+        on_delete=models.CASCADE,
+    )
+    vector = SearchVectorField(null=True)
+
+    class Meta:
+        indexes = [GinIndex(fields=["vector"])]
+
+    @staticmethod
+    def search_config():
+        return getattr(settings, "PRODUCT_SEARCH_CONFIG", "simple")
+
+    @classmethod
+    def index_product(cls, product, create=True):
+        """
+        Index the product again. Without ``create`` only an existing document is
+        updated, used when the product itself may be being deleted.
+        """
+        values = product.attribute_values.values_list(
+            "value_option__option", "value_text"
+        )
+        attributes = " ".join(value for row in values for value in row if value)
+        config = cls.search_config()
+        vector = (
+            SearchVector(
+                Value(product.title or "", output_field=TextField()),
+                weight="A",
+                config=config,
+            )
+            + SearchVector(
+                Value(product.description or "", output_field=TextField()),
+                weight="B",
+                config=config,
+            )
+            + SearchVector(
+                Value(attributes, output_field=TextField()), weight="C", config=config
+            )
+        )
+        if create:
+            cls.objects.update_or_create(product=product, defaults={"vector": vector})
+        else:
+            cls.objects.filter(product_id=product.pk).update(vector=vector)
+
+    @classmethod
+    def search(cls, queryset, search):
+        """ Refine a product queryset with a ranked prefix search """
+        terms = re.findall(r"\w+", search or "")
+        if not terms:
+            return queryset
+        query = SearchQuery(
+            " & ".join("%s:*" % term for term in terms),
+            search_type="raw",
+            config=cls.search_config(),
+        )
+        return queryset.filter(search_document__vector=query).annotate(
+            rank=SearchRank(F("search_document__vector"), query)
+        )
+
+
+class DailyIncome(models.Model):
+    """
+    Income of a vendor per category per day, rolled up from the completed
+    payments so the income tracker reads a few rows instead of aggregating
+    every transaction.
+    """
+
+    vendor = models.ForeignKey(
+        "vendor.Vendor", related_name="daily_income", on_delete=models.CASCADE
+    )
+    category = models.CharField(max_length=255, null=True, blank=True)
+    day = models.DateField()
+    amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ("vendor", "category", "day")
+        indexes = [models.Index(fields=["vendor", "day"])]
+
+    @staticmethod
+    def completed_payments():
+        return Transaction.objects.filter(
+            payment__isnull=False,
+            payment__amount__gte=0,
+            payment__order__status="completed",
+        )
+
+    @classmethod
+    def refresh(cls, vendor_id, day):
+        """ Roll up the income of one vendor for one day again """
+        Vendor = cls._meta.get_field("vendor").related_model
+        with transaction.atomic():
+            # Refreshes of one vendor wait for each other, otherwise both could
+            # delete the old rows and insert the same new ones
+            Vendor.objects.select_for_update().filter(pk=vendor_id).first()
+            rows = (
+                cls.completed_payments()
+                .filter(vendor_id=vendor_id, created__date=day)
+                .values(category=F("payment__order__product__categories__name"))
+                .annotate(amount=Sum("payment__amount"))
+            )
+            incomes = [
+                cls(
+                    vendor_id=vendor_id,
+                    day=day,
+                    category=row["category"],
+                    amount=row["amount"],
+                )
+                for row in rows
+            ]
+            cls.objects.filter(vendor_id=vendor_id, day=day).delete()
+            cls.objects.bulk_create(incomes)
+        bump_vendor_cache_version(vendor_id, "income")
+        bump_vendor_cache_version(vendor_id, "dashboard")
+
+    @classmethod
+    def refresh_for(cls, transactions):
+        for vendor_id, day in (
+            transactions.annotate(day=TruncDate("created"))
+            .values_list("vendor_id", "day")
+            .distinct()
+        ):
+            cls.refresh(vendor_id, day)
+
+    @classmethod
+    def rebuild(cls, vendor_ids=None):
+        """ Roll up all completed payments again, used to backfill """
+        payments = cls.completed_payments()
+        incomes = cls.objects.all()
+        if vendor_ids is not None:
+            payments = payments.filter(vendor_id__in=vendor_ids)
+            incomes = incomes.filter(vendor_id__in=vendor_ids)
+        rows = (
+            payments.annotate(
+                day=TruncDate("created"),
+                category=F("payment__order__product__categories__name"),
+            )
+            .values("vendor_id", "day", "category")
+            .annotate(amount=Sum("payment__amount"))
+            .order_by()
+        )
+        new_incomes = [cls(**row) for row in rows.iterator()]
+        with transaction.atomic():
+            incomes.delete()
+            cls.objects.bulk_create(new_incomes, batch_size=1000)
+        for vendor_id in {income.vendor_id for income in new_incomes}.union(
+            vendor_ids or ()
+        ):
+            bump_vendor_cache_version(vendor_id, "income")
+        return len(new_incomes)
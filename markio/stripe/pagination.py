@@ -0,0 +1,133 @@
+import hashlib
+
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db.models.signals import post_delete, post_save
+from django.utils.functional import cached_property
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+from rest_framework.response import Response
+
+COUNT_CACHE_TIMEOUT = 60 * 5
+
+
+def _count_version_key(model):
+    return "pagination:count_version:%s" % model._meta.label_lower
+
+
+def invalidate_counts(sender, **kwargs):
+    """ Bump the count version of a model, cached counts of older versions are ignored """
+    try:
+        cache.incr(_count_version_key(sender))
+    except ValueError:
+        cache.set(_count_version_key(sender), 1, None)
+
+
+def cache_counts_for(*models):
+    """ Invalidate the cached page counts of these models when they are written to """
+    for model in models:
+        post_save.connect(invalidate_counts, sender=model, weak=False)
+        post_delete.connect(invalidate_counts, sender=model, weak=False)
+
+
+class CachedCountPaginator(Paginator):
+    """
+    Paginator that caches the count of a filtered queryset.
+
+    The count is keyed on the SQL of the queryset and the count version of its
+    model, see ``cache_counts_for``. Writes through ``bulk_create`` or ``update``
+    don't send signals and rely on the timeout or an explicit ``invalidate_counts``.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not hasattr(queryset, "query"):
+            return super().count
+        version = cache.get_or_set(_count_version_key(queryset.model), 1, None)
+        sql, params = queryset.query.sql_with_params()
+        digest = hashlib.md5(("%s%r" % (sql, params)).encode()).hexdigest()
+        key = "pagination:count:%s:%s:%s" % (
+            queryset.model._meta.label_lower,
+            version,
+            digest,
+        )
+        count = cache.get(key)
+        if count is None:
+            count = super().count
+            cache.set(key, count, COUNT_CACHE_TIMEOUT)
+        return count
+
+
+class StandardResultsSetPagination(PageNumberPagination):
+    """
+    Page number pagination with a cached count and a windowed page range.
+
+    A view can set ``page_size`` and ``max_page_size`` to change the defaults,
+    the page size is never larger than ``MAX_PAGE_SIZE``. ``num_pages`` holds the
+    first page, the last page and the pages around the current one with ``None``
+    for the gaps, e.g. ``[1, None, 4, 5, 6, None, 20]``.
+    """
+
+    page_size = 20
+    page_size_query_param = "page_size"
+    max_page_size = 50
+    page_window = 2
+    django_paginator_class = CachedCountPaginator
+
+    MAX_PAGE_SIZE = 100
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = min(
+            getattr(view, "page_size", self.page_size), self.MAX_PAGE_SIZE
+        )
+        self.max_page_size = min(
+            getattr(view, "max_page_size", self.max_page_size), self.MAX_PAGE_SIZE
+        )
+        return super().paginate_queryset(queryset, request, view=view)
+
+    def get_page_range(self):
+        current = self.page.number
+        last = self.page.paginator.num_pages
+        pages = {1, last}
+        first_in_window = max(1, current - self.page_window)
+        last_in_window = min(last, current + self.page_window)
+        pages.update(range(first_in_window, last_in_window + 1))
+        page_range = []
+        for number in sorted(pages):
+            if page_range and number - page_range[-1] > 1:
+                page_range.append(None)
+            page_range.append(number)
+        return page_range
+
+    def get_paginated_response(self, data):
+        return Response(
+            {
+                "links": {
+                    "next": self.get_next_link(),
+                    "previous": self.get_previous_link(),
+                },
+                "count": self.page.paginator.count,
+                "current_page": self.page.number,
+                "last_page": self.page.paginator.num_pages,
+                "num_pages": self.get_page_range(),
+                "results": data,
+            }
+        )
+
+
+class ReviewCursorPagination(CursorPagination):
+    """ Reviews of a product, newest first """
+
+    page_size = 20
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    ordering = ("-date_created", "-id")
+
+
+class OperationCursorPagination(CursorPagination):
+    """ Balance operations of a vendor, newest first """
+
+    page_size = 25
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    ordering = ("-created", "-id")
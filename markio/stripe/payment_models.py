@@ -0,0 +1,489 @@
+import time
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+
+from django.db import models, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from snap.apps.marketplace.models import Order, Payment, Transaction
+
+
+class LedgerBalance(models.Model):
+    """
+    Materialized balance of a vendor, only changed together with a new
+    ``LedgerEntry`` while the row is locked.
+
+    ``reserved`` is the part of ``available`` held by payouts that are being
+    sent to Stripe, it is released once the payout is recorded or failed.
+    """
+
+    vendor = models.OneToOneField(
+        "vendor.Vendor", related_name="ledger_balance", on_delete=models.CASCADE
+    )
+    available = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    pending = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    paid_out = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    reserved = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def locked(cls, vendor_id):
+        """ Balance of the vendor, locked until the end of the transaction """
+        cls.objects.get_or_create(vendor_id=vendor_id)
+        return cls.objects.select_for_update().get(vendor_id=vendor_id)
+
+    @classmethod
+    def reserve(cls, vendor_id, amount):
+        """ Hold ``amount`` of the available balance, False when it isn't there """
+        amount = Decimal(str(amount))
+        with transaction.atomic():
+            balance = cls.locked(vendor_id)
+            if amount > balance.available - balance.reserved:
+                return False
+            balance.reserved = F("reserved") + amount
+            balance.save(update_fields=["reserved", "updated"])
+        return True
+
+    @classmethod
+    def release(cls, vendor_id, amount):
+        """ Give back an amount held by ``reserve`` """
+        with transaction.atomic():
+            balance = cls.locked(vendor_id)
+            balance.reserved = F("reserved") - Decimal(str(amount))
+            balance.save(update_fields=["reserved", "updated"])
+
+
+class LedgerEntry(models.Model):
+    """
+    Append-only record of every change to the balance of a vendor.
+
+    There is at most one entry of a kind per payment or payout, recording the
+    same event twice doesn't change the balance again. A pending payment that
+    is no longer pending is cleared and a completed payment that is refunded,
+    failed or whose order is no longer completed is reversed, both at most once.
+    A change to the amount of a completed payment adds an adjustment, the only
+    kind a payment can have more than once.
+    """
+
+    PAYMENT_PENDING = "payment_pending"
+    PAYMENT_PENDING_CLEARED = "payment_pending_cleared"
+    PAYMENT_COMPLETED = "payment_completed"
+    PAYMENT_REVERSED = "payment_reversed"
+    PAYMENT_ADJUSTED = "payment_adjusted"
+    PAYOUT = "payout"
+    PAYOUT_REVERSED = "payout_reversed"
+    KIND_CHOICES = [
+        (PAYMENT_PENDING, "Payment pending"),
+        (PAYMENT_PENDING_CLEARED, "Payment pending cleared"),
+        (PAYMENT_COMPLETED, "Payment completed"),
+        (PAYMENT_REVERSED, "Payment reversed"),
+        (PAYMENT_ADJUSTED, "Payment adjusted"),
+        (PAYOUT, "Payout"),
+        (PAYOUT_REVERSED, "Payout reversed"),
+    ]
+
+    vendor = models.ForeignKey(
+        "vendor.Vendor", related_name="ledger_entries", on_delete=models.CASCADE
+    )
+    kind = models.CharField(max_length=32, choices=KIND_CHOICES)
+    available = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    pending = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    paid_out = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    payment = models.ForeignKey(
+        "marketplace.Payment", null=True, blank=True, on_delete=models.PROTECT
+    )
+    payout = models.ForeignKey(
+        "marketplace.Payout", null=True, blank=True, on_delete=models.PROTECT
+    )
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["vendor", "created"])]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["kind", "payment"],
+                condition=Q(payment__isnull=False) & ~Q(kind="payment_adjusted"),
+                name="unique_ledger_payment_kind",
+            ),
+            models.UniqueConstraint(
+                fields=["kind", "payout"],
+                condition=Q(payout__isnull=False),
+                name="unique_ledger_payout_kind",
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.pk:
+            raise ValueError("Ledger entries can't be changed")
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def record(
+        cls,
+        vendor_id,
+        kind,
+        available=0,
+        pending=0,
+        paid_out=0,
+        payment=None,
+        payout=None,
+    ):
+        """ Add an entry and apply it to the locked balance of the vendor """
+        # Amounts can come in as floats from the Stripe helpers
+        available, pending, paid_out = (
+            Decimal(str(amount)) for amount in (available, pending, paid_out)
+        )
+        with transaction.atomic():
+            balance = LedgerBalance.locked(vendor_id)
+            if (
+                (payment or payout)
+                and kind != cls.PAYMENT_ADJUSTED
+                and cls.objects.filter(
+                    kind=kind, payment=payment, payout=payout
+                ).exists()
+            ):
+                return balance
+            cls.objects.create(
+                vendor_id=vendor_id,
+                kind=kind,
+                available=available,
+                pending=pending,
+                paid_out=paid_out,
+                payment=payment,
+                payout=payout,
+            )
+            balance.available = F("available") + available
+            balance.pending = F("pending") + pending
+            balance.paid_out = F("paid_out") + paid_out
+            balance.save(update_fields=["available", "pending", "paid_out", "updated"])
+            balance.refresh_from_db(fields=["available", "pending", "paid_out"])
+        return balance
+
+    @classmethod
+    def sync_payment(cls, payment):
+        """ Bring the entries of a payment in line with its current state """
+        vendor_id = (
+            Transaction.objects.filter(payment=payment)
+            .values_list("vendor_id", flat=True)
+            .first()
+        )
+        if vendor_id is None:
+            return None
+        pending = payment.status == "pending"
+        completed = (
+            payment.status == Payment.SUCCESS
+            and payment.order.status == Order.COMPLETED
+        )
+        with transaction.atomic():
+            # Syncs of one vendor are serialized on its balance row
+            balance = LedgerBalance.locked(vendor_id)
+            payment_entries = list(
+                cls.objects.filter(vendor_id=vendor_id, payment=payment)
+            )
+            entries = {entry.kind: entry for entry in payment_entries}
+            # Only the completed, adjusted and reversed entries move available
+            available = sum(entry.available for entry in payment_entries)
+            if pending and cls.PAYMENT_PENDING not in entries:
+                balance = cls.record(
+                    vendor_id, cls.PAYMENT_PENDING, pending=payment.amount, payment=payment
+                )
+            elif (
+                not pending
+                and cls.PAYMENT_PENDING in entries
+                and cls.PAYMENT_PENDING_CLEARED not in entries
+            ):
+                balance = cls.record(
+                    vendor_id,
+                    cls.PAYMENT_PENDING_CLEARED,
+                    pending=-entries[cls.PAYMENT_PENDING].pending,
+                    payment=payment,
+                )
+            if completed and cls.PAYMENT_COMPLETED not in entries:
+                balance = cls.record(
+                    vendor_id,
+                    cls.PAYMENT_COMPLETED,
+                    available=payment.amount,
+                    payment=payment,
+                )
+            elif (
+                completed
+                and cls.PAYMENT_REVERSED not in entries
+                and available != Decimal(str(payment.amount))
+            ):
+                balance = cls.record(
+                    vendor_id,
+                    cls.PAYMENT_ADJUSTED,
+                    available=Decimal(str(payment.amount)) - available,
+                    payment=payment,
+                )
+            elif (
+                not completed
+                and cls.PAYMENT_COMPLETED in entries
+                and cls.PAYMENT_REVERSED not in entries
+            ):
+                balance = cls.record(
+                    vendor_id, cls.PAYMENT_REVERSED, available=-available, payment=payment
+                )
+        return balance
+
+    @classmethod
+    def record_payout(cls, vendor_id, payout):
+        return cls.record(
+            vendor_id,
+            cls.PAYOUT,
+            available=-payout.amount,
+            paid_out=payout.amount,
+            payout=payout,
+        )
+
+    @classmethod
+    def reverse_payout(cls, vendor_id, payout):
+        if not cls.objects.filter(kind=cls.PAYOUT, payout=payout).exists():
+            return None
+        return cls.record(
+            vendor_id,
+            cls.PAYOUT_REVERSED,
+            available=payout.amount,
+            paid_out=-payout.amount,
+            payout=payout,
+        )
+
+
+class VendorOperation(models.Model):
+    """
+    One row per transaction of a vendor with its type, source and amount
+    already resolved, read by the operations and invoices feeds of the
+    balance dashboard.
+    """
+
+    PAYMENT = "payment"
+    PAYOUT = "payout"
+    SOURCE_CHOICES = [(PAYMENT, "From customer"), (PAYOUT, "From application")]
+
+    vendor = models.ForeignKey(
+        "vendor.Vendor", related_name="operations", on_delete=models.CASCADE
+    )
+    transaction = models.OneToOneField(
+        "marketplace.Transaction", related_name="operation", on_delete=models.CASCADE
+    )
+    type = models.CharField(max_length=32, null=True, blank=True)
+    source = models.CharField(max_length=16, choices=SOURCE_CHOICES, null=True)
+    amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    currency = models.CharField(max_length=3, default="USD")
+    status = models.CharField(max_length=32, null=True, blank=True)
+    product_name = models.CharField(max_length=255, null=True, blank=True)
+    payment = models.ForeignKey(
+        "marketplace.Payment", null=True, blank=True, on_delete=models.SET_NULL
+    )
+    created = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["vendor", "-created", "-id"], name="operation_vendor_created"
+            ),
+            models.Index(
+                fields=["vendor", "source", "-created", "-id"],
+                name="operation_vendor_source",
+            ),
+        ]
+
+    @staticmethod
+    def _operation_transactions():
+        return Transaction.objects.select_related(
+            "payment__order__product", "payout"
+        )
+
+    @classmethod
+    def _from_transaction(cls, transaction_):
+        payment, payout = transaction_.payment, transaction_.payout
+        if payment is not None:
+            source, amount, status = cls.PAYMENT, payment.amount, payment.status
+            product_name = payment.order.product.title
+        elif payout is not None:
+            source, amount, status = cls.PAYOUT, payout.amount, payout.status
+            product_name = None
+        else:
+            source, amount, status, product_name = None, 0, None, None
+        return cls(
+            vendor_id=transaction_.vendor_id,
+            transaction=transaction_,
+            type=transaction_._type,
+            source=source,
+            amount=amount if amount and amount >= 0 else 0,
+            status=status,
+            product_name=product_name,
+            payment=payment,
+            created=transaction_.created,
+        )
+
+    @classmethod
+    def sync(cls, transaction_id):
+        """ Write the operation of one transaction again """
+        transaction_ = cls._operation_transactions().get(pk=transaction_id)
+        operation = cls._from_transaction(transaction_)
+        operation.pk = (
+            cls.objects.filter(transaction_id=transaction_id)
+            .values_list("pk", flat=True)
+            .first()
+        )
+        operation.save()
+        return operation
+
+    @classmethod
+    def sync_payment(cls, payment):
+        cls.objects.filter(payment=payment).update(status=payment.status)
+
+    @classmethod
+    def sync_payout(cls, payout):
+        cls.objects.filter(transaction__payout=payout).update(status=payout.status)
+
+    @classmethod
+    def rebuild(cls, vendor_ids=None):
+        """ Write the operations of every transaction again, used to backfill """
+        transactions = cls._operation_transactions()
+        operations = cls.objects.all()
+        if vendor_ids is not None:
+            transactions = transactions.filter(vendor_id__in=vendor_ids)
+            operations = operations.filter(vendor_id__in=vendor_ids)
+        new_operations = [
+            cls._from_transaction(transaction_)
+            for transaction_ in transactions.iterator()
+        ]
+        with transaction.atomic():
+            operations.delete()
+            cls.objects.bulk_create(new_operations, batch_size=1000)
+        return len(new_operations)
+
+
+class PayoutJob(models.Model):
+    """
+    Payout requested by a vendor, executed in the background by a payout
+    worker. The outcome of ``VendorBalanceWithdraw.create_payout`` is kept in
+    ``result`` for the status endpoint.
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (SUCCEEDED, "Succeeded"),
+        (FAILED, "Failed"),
+    ]
+
+    vendor = models.ForeignKey(
+        "vendor.Vendor", related_name="payout_jobs", on_delete=models.CASCADE
+    )
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "created"])]
+
+    @property
+    def idempotency_key(self):
+        # Running a job again never creates a second payout at Stripe
+        return "payout-job:%s" % self.pk
+
+    @classmethod
+    def claim(cls, pk=None):
+        """
+        Mark the oldest queued job, or the queued job ``pk``, as running and
+        return it, None when there is none.
+
+        Rows locked by another worker are skipped so workers never claim the
+        same job. Running jobs are never claimed again, the payout of a job
+        whose worker died may exist at Stripe and is checked by hand.
+        """
+        now = timezone.now()
+        jobs = cls.objects.select_for_update(skip_locked=True).filter(status=cls.QUEUED)
+        if pk is not None:
+            jobs = jobs.filter(pk=pk)
+        with transaction.atomic():
+            job = jobs.order_by("created").first()
+            if job is None:
+                return None
+            job.status, job.started = cls.RUNNING, now
+            job.attempts += 1
+            job.save(update_fields=["status", "started", "attempts"])
+        return job
+
+    def finish(self, result=None, error=None):
+        """ Store the outcome of a running job, a finished job is never changed """
+        succeeded = error is None and bool(result) and result.get("status") not in (
+            "unapproved",
+            "error",
+            "failed",
+            "canceled",
+        )
+        self.status = self.SUCCEEDED if succeeded else self.FAILED
+        self.result = result
+        self.error = error
+        self.finished = timezone.now()
+        type(self).objects.filter(pk=self.pk, status=self.RUNNING).update(
+            status=self.status,
+            result=self.result,
+            error=self.error,
+            finished=self.finished,
+        )
+
+
+class StripeEvent(models.Model):
+    """
+    Webhook event pushed by Stripe, stored as received before it is processed
+    so no event is lost when processing fails. Stripe delivers an event at
+    least once, the unique ``stripe_id`` drops the duplicates.
+    """
+
+    MAX_ATTEMPTS = 5
+
+    stripe_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=100)
+    object_id = models.CharField(max_length=255, null=True, blank=True)
+    data = models.JSONField()
+    created = models.DateTimeField()
+    received = models.DateTimeField(auto_now_add=True)
+    processed = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["created"],
+                condition=Q(processed__isnull=True),
+                name="stripe_event_unprocessed",
+            )
+        ]
+
+    @classmethod
+    def ingest(cls, event):
+        """ Store a verified event, returns the event and if it is new """
+        data = event.get("data") or {}
+        return cls.objects.get_or_create(
+            stripe_id=event.get("id"),
+            defaults={
+                "type": event.get("type"),
+                "object_id": (data.get("object") or {}).get("id"),
+                "data": data,
+                "created": datetime.fromtimestamp(
+                    event.get("created") or time.time(), tz=dt_timezone.utc
+                ),
+            },
+        )
+
+    @classmethod
+    def unprocessed(cls):
+        return cls.objects.filter(
+            processed__isnull=True, attempts__lt=cls.MAX_ATTEMPTS
+        ).order_by("created")
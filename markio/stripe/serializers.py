@@ -1,4 +1,6 @@
-from django.db.models import Count
+from collections import Counter, defaultdict
+
+from django.db.models import F, Q
 from django.utils.functional import cached_property
 from oscar.core.loading import get_class, get_model
 from oscarapi.serializers import checkout, product
@@ -8,7 +10,11 @@ from rest_framework import status
 from rest_framework.exceptions import APIException
 
 from snap.apps.catalogue import utils as catalogue_utils
-from snap.apps.catalogue.models import Product
+from snap.apps.catalogue.models import (
+    Product,
+    ProductRatingSummary,
+)
+from snap.apps.marketplace.payment_models import PayoutJob, VendorOperation
 from snap.utils import (
     absolute_product_url,
     absolute_dashboard_product_url,
@@ -17,6 +23,8 @@ from snap.utils import (
 
 import json
 
+ProductAttributeValue = get_model("catalogue", "ProductAttributeValue")
+
 
 class TotalReviewBarSerializer(serializers.Serializer):
     score = serializers.IntegerField()
@@ -27,6 +35,101 @@ class TotalReviewBarSerializer(serializers.Serializer):
         fields = "__all__"
 
 
+class VendorOperationSerializer(serializers.ModelSerializer):
+    day = serializers.IntegerField(source="created.day", read_only=True)
+    month = serializers.IntegerField(source="created.month", read_only=True)
+    _from = serializers.CharField(source="get_source_display", read_only=True)
+
+    class Meta:
+        model = VendorOperation
+        fields = ["id", "created", "day", "month", "type", "amount", "_from", "currency"]
+
+
+class VendorInvoiceSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = VendorOperation
+        fields = ["id", "created", "status", "amount", "product_name"]
+
+
+class PayoutJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PayoutJob
+        fields = ["id", "amount", "status", "result", "error", "created", "finished"]
+
+
+def fetch_purchase_info(strategy, products):
+    """
+    Purchase info of a page of products keyed by product id.
+
+    The stockrecord is taken from the prefetched ``stockrecords`` so the strategy
+    doesn't have to look it up again for every product.
+    """
+    purchase_info = {}
+    for product in products:
+        if product.is_parent:
+            purchase_info[product.pk] = strategy.fetch_for_parent(product)
+            continue
+        stockrecords = product.stockrecords.all()
+        purchase_info[product.pk] = strategy.fetch_for_product(
+            product, stockrecord=stockrecords[0] if stockrecords else None
+        )
+    return purchase_info
+
+
+class ProductVariantLoader:
+    """
+    Load the variants of a page of products in a constant number of queries.
+
+    Children, parents and siblings of every product on the page are fetched in
+    one query and their attribute values in a second one. The variants are then
+    serialized from this in-memory index.
+    """
+
+    def __init__(self, products):
+        products = list(products)
+        parent_ids = {product.pk for product in products if product.is_parent}
+        parent_ids.update(product.parent_id for product in products if product.is_child)
+        self.product_ids = {product.pk for product in products}
+        self.products = {}
+        self.children = defaultdict(list)
+        self.attributes = defaultdict(list)
+        if not parent_ids:
+            return
+        for variant in Product.objects.filter(
+            Q(pk__in=parent_ids) | Q(parent_id__in=parent_ids)
+        ):
+            self.products[variant.pk] = variant
+            if variant.parent_id:
+                self.children[variant.parent_id].append(variant)
+        for value in ProductAttributeValue.objects.filter(
+            product_id__in=self.products
+        ).values(
+            "product_id",
+            name=F("attribute__name"),
+            code=F("attribute__code"),
+            value=F("value_option__option"),
+        ):
+            self.attributes[value.pop("product_id")].append(value)
+
+    def __contains__(self, instance):
+        return instance.pk in self.product_ids
+
+    def to_dict(self, product):
+        return product.to_variant_dict(attributes=self.attributes[product.pk])
+
+    def variants(self, instance):
+        variants = []
+        if instance.is_parent:
+            for variant in self.children[instance.pk]:
+                variants.append(self.to_dict(variant))
+        if instance.is_child:
+            variants.append(self.to_dict(self.products[instance.parent_id]))
+            for sibling in self.children[instance.parent_id]:
+                if sibling.pk != instance.pk:
+                    variants.append(self.to_dict(sibling))
+        return variants
+
+
 class ProductSerializer(product.ProductSerializer):
     price = serializers.SerializerMethodField()
     variants = serializers.SerializerMethodField("get_variants")
@@ -82,78 +185,120 @@ class ProductSerializer(product.ProductSerializer):
     def get_dashboard_url(self, instance):
         return absolute_dashboard_product_url(instance.pk)
 
+    def get_page(self, instance):
+        # All products that are serialized together with this instance
+        if isinstance(self.parent, serializers.ListSerializer):
+            return self.parent.instance
+        return [instance]
+
+    def get_strategy(self):
+        # One pricing strategy for the whole serialization
+        strategy = self.context.get("strategy")
+        if strategy is None:
+            request = self.context.get("request")
+            strategy = Selector().strategy(request=request, user=request.user)
+            self.context["strategy"] = strategy
+        return strategy
+
+    def get_purchase_info(self, instance):
+        purchase_info = self.context.get("purchase_info")
+        if purchase_info is None or instance.pk not in purchase_info:
+            purchase_info = fetch_purchase_info(
+                self.get_strategy(), self.get_page(instance)
+            )
+            self.context["purchase_info"] = purchase_info
+        return purchase_info[instance.pk]
+
     def get_price(self, instance):
         request = self.context.get("request")
-        strategy = Selector().strategy(request=request, user=request.user)
-
         ser = checkout.PriceSerializer(
-            strategy.fetch_for_product(instance).price, context={"request": request}
+            self.get_purchase_info(instance).price, context={"request": request}
         )
         return ser.data
 
     @staticmethod
     def setup_eager_loading(queryset):
         """ Perform necessary eager loading of data. """
-        queryset = queryset.prefetch_related(
+        queryset = queryset.select_related(
+            "vendor__user", "rating_summary__top_review"
+        ).prefetch_related(
             "reviews",
             "product_class",
             "images",
             "stockrecords",
             "attributes",
             "categories",
-            "attribute_values",
+            "attribute_values__attribute",
         )
         return queryset
 
+    def get_variant_loader(self, instance):
+        # One loader for the whole page when serializing with many=True
+        loader = self.context.get("variant_loader")
+        if loader is None or instance not in loader:
+            loader = ProductVariantLoader(self.get_page(instance))
+            self.context["variant_loader"] = loader
+        return loader
+
     def get_variants(self, instance):
-        variants = []
-        if instance.is_parent:
-            for variant in instance.children.all():
-                variants.append(variant.to_dict)
-        if instance.is_child:
-            variants.append(instance.parent.to_dict)
-            for sibling in instance.parent.children.exclude(id=instance.id):
-                variants.append(sibling.to_dict)
+        variants = self.get_variant_loader(instance).variants(instance)
         serializer = ProductVariantSerializer(variants, many=True)
         return serializer.data
 
+    @staticmethod
+    def get_rating_summary(instance):
+        try:
+            return instance.rating_summary
+        except ProductRatingSummary.DoesNotExist:
+            return None
+
     def get_top_review(self, obj):
-        if obj.reviews.exists():
-            top_review = obj.reviews.order_by("-delta_votes")[0]
+        summary = self.get_rating_summary(obj)
+        if summary:
+            top_review = summary.top_review
+        else:
+            # Work from the prefetched reviews, filtering or ordering would query again
+            reviews = obj.reviews.all()
+            top_review = max(reviews, key=lambda review: review.delta_votes, default=None)
+        if top_review:
             serializer = ProductReviewSerializer(top_review)
             return serializer.data
         return None
 
     def get_total_reviews(self, instance):
-        return instance.reviews.all().count()
+        summary = self.get_rating_summary(instance)
+        if summary:
+            return summary.total
+        return len(instance.reviews.all())
 
     def get_total_reviews_bar(self, instance):
-        if instance.reviews.exists():
-            total_reviews = instance.reviews.count()
+        summary = self.get_rating_summary(instance)
+        if summary:
+            total_reviews = summary.total
+            counts = summary.counts
+        else:
+            reviews = instance.reviews.all()
+            total_reviews = len(reviews)
+            counts = Counter(review.score for review in reviews)
+        if total_reviews:
             divide_by = 100 / total_reviews
             scores = []
-            seen = []
-            for score_item in (
-                instance.reviews.values("score")
-                .order_by("score")
-                .annotate(count=Count("score"))
-            ):
-                percentage = score_item.get("count") * divide_by
-                score_item.update({"percentage": percentage})
-                scores.append(score_item)
-                seen.append(score_item.get("score"))
-            for number in range(1, 6):
-                if number not in seen:
-                    scores.append({"score": number, "count": 0, "percentage": 0})
-            serializer = TotalReviewBarSerializer(
-                sorted(scores, key=lambda k: k["score"], reverse=True), many=True
-            )
+            for number in range(5, 0, -1):
+                scores.append(
+                    {
+                        "score": number,
+                        "count": counts[number],
+                        "percentage": counts[number] * divide_by,
+                    }
+                )
+            serializer = TotalReviewBarSerializer(scores, many=True)
             return serializer.data
         return None
 
     def get_image(self, instance):
-        if instance.images.exists():
-            image = instance.images.first()
+        images = instance.images.all()
+        if images:
+            image = images[0]
             return {
                 "url": image.original.url,
                 "alt_text": image.alt_text,
@@ -162,7 +307,7 @@ class ProductSerializer(product.ProductSerializer):
         return None
 
     def get_images(self, instance):
-        if instance.images.exists():
+        if instance.images.all():
             images = []
             for image in instance.images.all():
                 images.append(
@@ -184,6 +329,7 @@ class ProductSerializer(product.ProductSerializer):
         return []
 
     def get_category(self, instance):
-        if instance.categories.exists():
-            return instance.categories.first().name
+        categories = instance.categories.all()
+        if categories:
+            return categories[0].name
         return None
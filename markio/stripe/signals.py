@@ -0,0 +1,205 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from oscar.core.loading import get_model
+
+from snap.apps.catalogue.models import (
+    STRIPE_METADATA_CACHE_KEY,
+    DailyIncome,
+    Product,
+    ProductRatingSummary,
+    ProductSearchDocument,
+)
+from snap.apps.marketplace.cache import bump_vendor_cache_version
+from snap.apps.marketplace.models import Dispute, Order, Payment, Payout, Transaction
+from snap.apps.marketplace.pagination import cache_counts_for
+from snap.apps.marketplace.payment_models import LedgerEntry, VendorOperation
+
+ProductAttributeValue = get_model("catalogue", "ProductAttributeValue")
+ProductReview = get_model("reviews", "ProductReview")
+
+cache_counts_for(ProductReview)
+
+
+@receiver(post_save, sender=Product)
+def product_refresh_stripe_metadata(sender, instance, **kwargs):
+    instance.refresh_stripe_metadata()
+
+
+@receiver(post_save, sender=ProductAttributeValue)
+def attribute_value_refresh_stripe_metadata(sender, instance, **kwargs):
+    instance.product.refresh_stripe_metadata()
+
+
+@receiver(post_delete, sender=ProductAttributeValue)
+def attribute_value_forget_stripe_metadata(sender, instance, **kwargs):
+    # Also sent while the product is deleted, it is built again when it is read
+    cache.delete(STRIPE_METADATA_CACHE_KEY % instance.product_id)
+
+
+@receiver(post_save, sender=Product)
+def product_update_search_document(sender, instance, **kwargs):
+    ProductSearchDocument.index_product(instance)
+
+
+@receiver(post_save, sender=ProductAttributeValue)
+def attribute_value_update_search_document(sender, instance, **kwargs):
+    ProductSearchDocument.index_product(instance.product)
+
+
+@receiver(post_delete, sender=ProductAttributeValue)
+def attribute_value_remove_from_search_document(sender, instance, **kwargs):
+    # Also sent while the product is deleted, don't create its document again
+    ProductSearchDocument.index_product(instance.product, create=False)
+
+
+@receiver(pre_save, sender=ProductReview)
+def review_remember_previous_score(sender, instance, **kwargs):
+    instance._previous = None
+    if instance.pk:
+        instance._previous = (
+            sender.objects.filter(pk=instance.pk)
+            .values("score", "delta_votes")
+            .first()
+        )
+
+
+@receiver(post_save, sender=ProductReview)
+def review_update_rating_summary(sender, instance, created, **kwargs):
+    previous = getattr(instance, "_previous", None)
+    if previous and previous["score"] == instance.score:
+        summary = ProductRatingSummary.for_product(instance.product_id)
+    else:
+        summary = ProductRatingSummary.apply_review(
+            instance.product_id,
+            score=instance.score,
+            old_score=previous["score"] if previous else None,
+        )
+    top_review = summary.top_review
+    if (
+        top_review is None
+        or top_review.pk == instance.pk
+        or instance.delta_votes > top_review.delta_votes
+    ):
+        summary.refresh_top_review()
+
+
+@receiver(post_delete, sender=ProductReview)
+def review_remove_from_rating_summary(sender, instance, **kwargs):
+    summary = ProductRatingSummary.apply_review(
+        instance.product_id, old_score=instance.score
+    )
+    if summary and summary.top_review_id in (None, instance.pk):
+        summary.refresh_top_review()
+
+
+@receiver(post_save, sender=Order)
+def order_refresh_daily_income(sender, instance, **kwargs):
+    transactions = Transaction.objects.filter(payment__order=instance)
+    transaction.on_commit(lambda: DailyIncome.refresh_for(transactions))
+
+
+@receiver(post_save, sender=Payment)
+def payment_refresh_daily_income(sender, instance, **kwargs):
+    transactions = Transaction.objects.filter(payment=instance)
+    transaction.on_commit(lambda: DailyIncome.refresh_for(transactions))
+
+
+@receiver(post_save, sender=Transaction)
+def transaction_refresh_daily_income(sender, instance, **kwargs):
+    if instance.payment_id:
+        transactions = Transaction.objects.filter(pk=instance.pk)
+        transaction.on_commit(lambda: DailyIncome.refresh_for(transactions))
+
+
+def bump_dashboards(vendor_ids):
+    # After commit so a refresh can't cache the old data under the new version
+    vendor_ids = set(vendor_ids)
+
+    def bump():
+        for vendor_id in vendor_ids:
+            if vendor_id:
+                bump_vendor_cache_version(vendor_id, "dashboard")
+
+    transaction.on_commit(bump)
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def order_bump_dashboard(sender, instance, **kwargs):
+    bump_dashboards(
+        Transaction.objects.filter(payment__order=instance).values_list(
+            "vendor_id", flat=True
+        )
+    )
+
+
+@receiver(post_save, sender=Payment)
+@receiver(post_delete, sender=Payment)
+def payment_bump_dashboard(sender, instance, **kwargs):
+    bump_dashboards(
+        Transaction.objects.filter(payment=instance).values_list("vendor_id", flat=True)
+    )
+
+
+@receiver(post_save, sender=Payout)
+@receiver(post_delete, sender=Payout)
+def payout_bump_dashboard(sender, instance, **kwargs):
+    bump_dashboards(
+        Transaction.objects.filter(payout=instance).values_list("vendor_id", flat=True)
+    )
+
+
+@receiver(post_save, sender=Transaction)
+@receiver(post_delete, sender=Transaction)
+def transaction_bump_dashboard(sender, instance, **kwargs):
+    bump_dashboards([instance.vendor_id])
+
+
+@receiver(post_save, sender=ProductReview)
+@receiver(post_delete, sender=ProductReview)
+def review_bump_dashboard(sender, instance, **kwargs):
+    bump_dashboards(
+        Product.objects.filter(pk=instance.product_id).values_list(
+            "vendor_id", flat=True
+        )
+    )
+
+
+@receiver(post_save, sender=Dispute)
+@receiver(post_delete, sender=Dispute)
+def dispute_bump_dashboard(sender, instance, **kwargs):
+    bump_dashboards([instance.vendor_id])
+
+
+@receiver(post_save, sender=Payment)
+def payment_sync_ledger(sender, instance, **kwargs):
+    LedgerEntry.sync_payment(instance)
+
+
+@receiver(post_save, sender=Order)
+def order_sync_ledger(sender, instance, **kwargs):
+    for payment in Payment.objects.filter(order=instance):
+        LedgerEntry.sync_payment(payment)
+
+
+@receiver(post_save, sender=Transaction)
+def transaction_sync_ledger(sender, instance, created, **kwargs):
+    if created and instance.payment_id:
+        LedgerEntry.sync_payment(instance.payment)
+
+
+@receiver(post_save, sender=Transaction)
+def transaction_sync_operation(sender, instance, **kwargs):
+    VendorOperation.sync(instance.pk)
+
+
+@receiver(post_save, sender=Payment)
+def payment_sync_operation(sender, instance, **kwargs):
+    VendorOperation.sync_payment(instance)
+
+
+@receiver(post_save, sender=Payout)
+def payout_sync_operation(sender, instance, **kwargs):
+    VendorOperation.sync_payout(instance)
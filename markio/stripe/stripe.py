@@ -1,16 +1,153 @@
+import logging
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
+import requests
 import stripe
 from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
 from django.db import transaction as atomic_transaction
+from django.db.models import F
 from django.apps import apps
+from django.utils import timezone
 
+from snap.apps.marketplace.cache import bump_vendor_cache_version
 
+logger = logging.getLogger(__name__)
+
+
+# ( connect, read ) timeouts in seconds per kind of call, reads fail fast and
+# calls that move money get more time. Overridden with STRIPE_HTTP_TIMEOUTS.
+STRIPE_TIMEOUTS = {
+    "read": (2, 10),
+    "write": (5, 30),
+    "checkout": (3, 20),
+    "payment": (5, 45),
+}
+
+
+class StripeRequestsClient(stripe.http_client.RequestsClient):
+    """ Requests client whose timeout is set per call with ``stripe_timeout`` """
+
+    _call = threading.local()
+
+    @property
+    def _timeout(self):
+        return getattr(self._call, "timeout", None) or self._default_timeout
+
+    @_timeout.setter
+    def _timeout(self, timeout):
+        self._default_timeout = timeout
+
+
+@contextmanager
+def stripe_timeout(kind):
+    """ Use the timeout of ``kind`` for the Stripe calls of this thread in the block,
+    also usable as a decorator. """
+    timeouts = dict(STRIPE_TIMEOUTS, **getattr(settings, "STRIPE_HTTP_TIMEOUTS", {}))
+    previous = getattr(StripeRequestsClient._call, "timeout", None)
+    StripeRequestsClient._call.timeout = timeouts[kind]
+    try:
+        yield
+    finally:
+        StripeRequestsClient._call.timeout = previous
+
+
+def stripe_configure_client():
+    """ Configure the process wide HTTP client used by every Stripe call.
+
+    Connections are kept alive in a bounded pool per worker so checkout and
+    payout calls reuse an open TLS connection. Failed requests are retried by
+    the Stripe library with exponential backoff, it sends its own idempotency
+    key with a retried POST request. The timeout comes from the
+    ``stripe_timeout`` of the call, ``STRIPE_HTTP_TIMEOUT`` is used outside one.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=getattr(settings, "STRIPE_POOL_CONNECTIONS", 2),
+        pool_maxsize=getattr(settings, "STRIPE_POOL_MAXSIZE", 10),
+        pool_block=True,
+    )
+    session.mount("https://", adapter)
+    # Either seconds or a ( connect, read ) tuple
+    timeout = getattr(settings, "STRIPE_HTTP_TIMEOUT", (5, 30))
+    stripe.default_http_client = StripeRequestsClient(timeout=timeout, session=session)
+    stripe.max_network_retries = getattr(settings, "STRIPE_MAX_NETWORK_RETRIES", 2)
+    return stripe.default_http_client
+
+
+stripe_configure_client()
+
+
+def stripe_idempotency_key(*parts):
+    """ Idempotency key for a Stripe POST request.
+
+    The same parts always give the same key so repeating a request can never
+    create a second object. Without a deterministic key leave it out, Stripe's
+    library adds one to its own retries.
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, ":".join(str(part) for part in parts)))
+
+
+class StripeAccountCache:
+    """ Read-through cache for Stripe Account objects keyed by stripe id.
+
+    Accounts are kept in the shared Django cache for ``ttl`` seconds, so an
+    invalidation after an ``account.updated`` webhook is seen by every process
+    and not only by the worker that received the event. ``clear`` bumps the
+    generation that is part of every key instead of flushing the whole cache.
+    """
+
+    generation_key = "stripe:account:generation"
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+
+    def _key(self, stripe_id):
+        generation = cache.get_or_set(self.generation_key, 1, None)
+        return "stripe:account:%s:%s" % (generation, stripe_id)
+
+    def get(self, stripe_id):
+        return cache.get(self._key(stripe_id))
+
+    def set(self, stripe_id, account):
+        cache.set(self._key(stripe_id), account, self.ttl)
+
+    def invalidate(self, stripe_id):
+        cache.delete(self._key(stripe_id))
+
+    def clear(self):
+        try:
+            cache.incr(self.generation_key)
+        except ValueError:
+            cache.set(self.generation_key, 2, None)
+
+    @stripe_timeout("read")
+    def retrieve(self, stripe_id):
+        account = self.get(stripe_id)
+        if account is None:
+            account = stripe.Account.retrieve(stripe_id)
+            if account:
+                self.set(stripe_id, account)
+        return account
+
+
+account_cache = StripeAccountCache(
+    ttl=getattr(settings, "STRIPE_ACCOUNT_CACHE_TTL", 60),
+)
+
+
+@stripe_timeout("write")
 def stripe_create_account(vendor, country):
     """ Connect a vendor to a stripe account
     """
     if not vendor.stripe_id and vendor.user.is_active:
         account = stripe.Account.create(
+            idempotency_key=stripe_idempotency_key("account", vendor.pk, country),
             country=country,
             type="custom",
             business_type="individual",
@@ -25,6 +162,7 @@ def stripe_create_account(vendor, country):
             },
         )
         stripe_id = account.get("id")
+        account_cache.set(stripe_id, account)
         vendor.stripe_id = stripe_id
         vendor.stripe_account = account
         vendor.stripe_uptodate = True
@@ -35,17 +173,19 @@ def stripe_create_account(vendor, country):
 
 def retrieve_stripe_account(vendor):
     if vendor.stripe_id:
-        account = stripe.Account.retrieve(vendor.stripe_id)
+        account = account_cache.retrieve(vendor.stripe_id)
         return account
     return None
 
 
+@stripe_timeout("write")
 def update_stripe_account(vendor, metatdata):
     """
     Meta data should be a dict with updated values for the Stripe account ( Vendor )
     """
     if not vendor.stripe_id:
         account = stripe.Account.modify(vendor.stripe_id, metatdata=metatdata)
+        account_cache.invalidate(vendor.stripe_id)
         return account
     return None
 
@@ -60,14 +200,194 @@ def stripe_retrieve_and_update_stripe_account(vendor):
         return None
 
 
+def stripe_accounts_updated(accounts):
+    """ Handle the accounts of ``account.updated`` webhook events.
+
+    ``accounts`` maps Stripe account ids to the pushed accounts. They are
+    stored on their vendors with one ``bulk_update`` and in the account cache
+    so the next read does not have to go back to Stripe. Returns the ids of
+    the updated vendors.
+    """
+    Vendor = apps.get_model("vendor", "Vendor")
+    vendors = list(Vendor.objects.filter(stripe_id__in=accounts))
+    for vendor in vendors:
+        vendor.stripe_account = accounts[vendor.stripe_id]
+    Vendor.objects.bulk_update(vendors, ["stripe_account"])
+    for stripe_id, account in accounts.items():
+        account_cache.set(stripe_id, account)
+    return {vendor.pk for vendor in vendors}
+
+
+# Stripe payout statuses that end a payout without paying it out
+STRIPE_PAYOUT_FAILED_STATUSES = ("failed", "canceled")
+
+stripe_event_executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="stripe-events"
+)
+
+
+def stripe_construct_event(payload, signature):
+    """ Verified webhook event of the payload, None when the signature is invalid """
+    try:
+        return stripe.Webhook.construct_event(
+            payload, signature, settings.STRIPE_WEBHOOK_SECRET
+        )
+    except (ValueError, stripe.error.SignatureVerificationError):
+        return None
+
+
+def stripe_ingest_event(event):
+    """
+    Store a webhook event, it is processed by ``stripe_process_pending_events``.
+
+    With ``STRIPE_EVENTS_IN_PROCESS`` ( default True ) a thread of this process
+    processes the pending events once the event is committed, otherwise the
+    ``process_stripe_events`` command does.
+    """
+    StripeEvent = apps.get_model("marketplace", "StripeEvent")
+    stored, created = StripeEvent.ingest(event)
+    if created and getattr(settings, "STRIPE_EVENTS_IN_PROCESS", True):
+        atomic_transaction.on_commit(
+            lambda: stripe_event_executor.submit(_process_pending_events_in_thread)
+        )
+    return stored
+
+
+def _process_pending_events_in_thread():
+    # The thread gets its own database connection, don't leak it
+    try:
+        stripe_process_pending_events()
+    finally:
+        connection.close()
+
+
+def stripe_process_events(events):
+    """
+    Apply a batch of stored webhook events.
+
+    Only the newest event of every account and payout is applied and vendors
+    and payouts are written with one ``bulk_update`` each. ``bulk_update``
+    sends no signals, the ledger, the operations and the dashboard caches are
+    updated here.
+    """
+    Payout = apps.get_model("marketplace", "Payout")
+    LedgerEntry = apps.get_model("marketplace", "LedgerEntry")
+    VendorOperation = apps.get_model("marketplace", "VendorOperation")
+    accounts = {}
+    payouts = {}
+    for event in sorted(events, key=lambda event: event.created):
+        if not event.object_id:
+            continue
+        if event.type == "account.updated":
+            accounts[event.object_id] = event.data.get("object")
+        elif event.type.startswith("payout."):
+            payouts[event.object_id] = event.data.get("object")
+        elif event.type in ("checkout.session.completed", "checkout.session.expired"):
+            stripe_checkout_session_completed({"data": event.data})
+
+    vendor_ids = stripe_accounts_updated(accounts)
+
+    failed = []
+    rows = list(
+        Payout.objects.filter(stripe_id__in=payouts).annotate(
+            ledger_vendor_id=F("transaction__vendor_id")
+        )
+    )
+    for payout in rows:
+        payout.data = payouts[payout.stripe_id]
+        vendor_ids.add(payout.ledger_vendor_id)
+        if (
+            payout.data.get("status") in STRIPE_PAYOUT_FAILED_STATUSES
+            and payout.status != Payout.FAILED
+        ):
+            payout.status = Payout.FAILED
+            failed.append(payout)
+    Payout.objects.bulk_update(rows, ["status", "data"])
+    VendorOperation.objects.filter(transaction__payout__in=failed).update(
+        status=Payout.FAILED
+    )
+    for payout in failed:
+        LedgerEntry.reverse_payout(payout.ledger_vendor_id, payout)
+
+    for vendor_id in vendor_ids - {None}:
+        bump_vendor_cache_version(vendor_id, "dashboard")
+
+
+def stripe_process_pending_events(limit=100):
+    """
+    Process up to ``limit`` pending webhook events, returns how many were
+    claimed.
+
+    The events stay locked until they are marked as processed, other workers
+    skip them. When the batch fails the events are processed one by one so a
+    single bad event doesn't hold back the others, it is tried again until
+    ``StripeEvent.MAX_ATTEMPTS``.
+    """
+    StripeEvent = apps.get_model("marketplace", "StripeEvent")
+    with atomic_transaction.atomic():
+        events = list(
+            StripeEvent.unprocessed().select_for_update(skip_locked=True)[:limit]
+        )
+        if not events:
+            return 0
+        errors = {}
+        try:
+            with atomic_transaction.atomic():
+                stripe_process_events(events)
+        except Exception:
+            for event in events:
+                try:
+                    with atomic_transaction.atomic():
+                        stripe_process_events([event])
+                except Exception as e:
+                    logger.exception("Stripe event %s failed", event.stripe_id)
+                    errors[event.pk] = str(e)
+        now = timezone.now()
+        for event in events:
+            event.attempts += 1
+            event.error = errors.get(event.pk)
+            event.processed = None if event.pk in errors else now
+        StripeEvent.objects.bulk_update(events, ["attempts", "error", "processed"])
+    return len(events)
+
+
 def _application_fee_amount(amount):
     application_fee_amount = int(int(amount) / 100 * 10)
     return str(application_fee_amount)
 
 
+def _checkout_session_cache_key(user, basket, product, quantity, amount):
+    key = stripe_idempotency_key(
+        "checkout", user.pk, basket.pk if basket else None, product.pk, quantity, amount
+    )
+    return "stripe:checkout_session:%s" % key
+
+
+@stripe_timeout("checkout")
 def stripe_checkout_session_create(
-    product, quantity, amount, user, success_url, cancel_url
+    product, quantity, amount, user, success_url, cancel_url, basket=None
 ):
+    """ Create a checkout session or reuse the open one for the same request.
+
+    Sessions are cached per user, basket, product, quantity and amount until
+    they expire, so a double click or retry returns the existing session id
+    without calling Stripe again.
+
+    The idempotency key includes a nonce that lives for a few seconds. Two
+    requests racing past the cache get the same session from Stripe, but a
+    later request never gets the replayed response of a completed or expired
+    session.
+    """
+    cache_key = _checkout_session_cache_key(user, basket, product, quantity, amount)
+    cached_session = cache.get(cache_key)
+    if cached_session and cached_session.get("expires_at") > time.time():
+        return cached_session
+    nonce = cache.get_or_set(
+        "%s:nonce" % cache_key,
+        lambda: uuid.uuid4().hex,
+        getattr(settings, "STRIPE_CHECKOUT_NONCE_TTL", 10),
+    )
+
     line_item = product.to_line_item
     str_amount = str(amount) + "00"
     str_application_fee = _application_fee_amount(str_amount)
@@ -75,6 +395,7 @@ def stripe_checkout_session_create(
         {"amount": str_amount, "quantity": quantity, "name": product.title}
     )
     session = stripe.checkout.Session.create(
+        idempotency_key=stripe_idempotency_key(cache_key, nonce),
         customer_email=user.email,
         payment_method_types=["card", "ideal"],
         line_items=[line_item],
@@ -82,20 +403,44 @@ def stripe_checkout_session_create(
         payment_intent_data={
             "application_fee_amount": str_application_fee,
             "transfer_data": {"destination": product.vendor.stripe_id},
-            "metadata": product.to_dict,
+            "metadata": product.stripe_metadata,
         },
         success_url=success_url,
         cancel_url=cancel_url,
     )
+    if session and session.get("status", "open") == "open":
+        # Stop reusing the session a minute before Stripe expires it
+        expires_at = min(
+            session.get("expires_at") or time.time() + 24 * 60 * 60,
+            time.time() + getattr(settings, "STRIPE_CHECKOUT_SESSION_TTL", 60 * 60),
+        ) - 60
+        cached_session = {"id": session.get("id"), "expires_at": expires_at}
+        timeout = int(expires_at - time.time())
+        cache.set(cache_key, cached_session, timeout=timeout)
+        cache.set(
+            "stripe:checkout_session_key:%s" % session.get("id"), cache_key, timeout
+        )
     return session
 
 
+def stripe_checkout_session_completed(event):
+    """ Stop reusing a checkout session once it is completed or expired. """
+    session = event.get("data", {}).get("object") or {}
+    session_key = "stripe:checkout_session_key:%s" % session.get("id")
+    cache_key = cache.get(session_key)
+    if cache_key:
+        cache.delete_many([cache_key, "%s:nonce" % cache_key, session_key])
+
+
+@stripe_timeout("write")
 def stripe_accept_tos(vendor):
     stripe.Account.modify(
         vendor.stripe_id, tos_acceptance={"date": int(time.time()), "ip": "8.8.8.8"}
     )
+    account_cache.invalidate(vendor.stripe_id)
 
 
+@stripe_timeout("write")
 def stripe_link_account(vendor_id, failure_url, succes_url, stripe_type):
     account_link = stripe.AccountLink.create(
         account=vendor_id,
@@ -115,7 +460,7 @@ def stripe_account_company_or_individual(vendor_id):
     User has company or individual type and want to update data
 
     """
-    account = stripe.Account.retrieve(vendor_id)
+    account = account_cache.retrieve(vendor_id)
 
     # Catch Scenario 1
     if not account.get("individual") or not account.get("company"):
@@ -127,13 +472,14 @@ def stripe_account_company_or_individual(vendor_id):
 
 
 def stripe_retrieve_account(vendor_id):
-    account = stripe.Account.retrieve(vendor_id)
+    account = account_cache.retrieve(vendor_id)
     if account:
         return account
     else:
         return None
 
 
+@stripe_timeout("write")
 def stripe_create_bank_account(
     vendor_id,
     country,
@@ -153,6 +499,7 @@ def stripe_create_bank_account(
             "default_for_currency": True,
         },
     )
+    account_cache.invalidate(vendor_id)
     if bank_account and bank_account.get("status") == "new":
         return (True, "Success")
     return (False, bank_account)
@@ -171,6 +518,7 @@ def stripe_retrieve_first_bank_account(vendor_id):
     return bank_account
 
 
+@stripe_timeout("write")
 def stripe_update_bank_account(
     vendor_id,
     country,
@@ -192,11 +540,13 @@ def stripe_update_bank_account(
                 "routing_number": routing_number,
             },
         )
+        account_cache.invalidate(vendor_id)
         if bank_account and bank_account.get("status") == "new":
             return (True, "Success")
     return (False, "Something went wrong it looks like you dont have a bank account")
 
 
+@stripe_timeout("read")
 def stripe_retrieve_country_spec(country):
     retrieve_country = stripe.CountrySpec.retrieve(country)
     supported_currencies = [{"value": None, "label": "----------"}]
@@ -214,14 +564,17 @@ def stripe_retrieve_country_spec(country):
         return (False, "Something went wrong.")
 
 
+@stripe_timeout("write")
 def stripe_delete_bank_account(vendor_id, bank_id):
     response = stripe.Account.delete_external_account(vendor_id, bank_id)
+    account_cache.invalidate(vendor_id)
     if response.get("deleted"):
         return (True, "Deleleted old bank account")
     else:
         return (False, "Something went wrong")
 
 
+@stripe_timeout("read")
 def stripe_retrieve_balance(vendor_id):
     balance = stripe.Balance.retrieve(stripe_account=vendor_id)
     if balance:
@@ -232,10 +585,17 @@ def stripe_retrieve_balance(vendor_id):
     return None
 
 
+@stripe_timeout("payment")
 def stripe_charge_create(
-    amount, application_fee_amount, vendor_id, description=None, source=None
+    amount,
+    application_fee_amount,
+    vendor_id,
+    description=None,
+    source=None,
+    idempotency_key=None,
 ):
     charge = stripe.Charge.create(
+        idempotency_key=idempotency_key,
         amount=amount,
         application_fee_amount=application_fee_amount,
         on_behalf_of=vendor_id,
@@ -247,24 +607,34 @@ def stripe_charge_create(
     return charge
 
 
+@stripe_timeout("read")
 def stripe_list_all_transfers(limit=100, destination=None):
     transfers = stripe.Transfer.list(limit=limit, destination=destination)
     return transfers
 
 
-def stripe_create_payout(vendor, amount, currency):
+@stripe_timeout("payment")
+def stripe_create_payout(
+    vendor, amount, currency=None, bank_account=None, idempotency_key=None
+):
     # Request payout for connected account ( Seller )
     Transaction = apps.get_model("marketplace", "Transaction")
     Payout = apps.get_model("marketplace", "Payout")
+    LedgerEntry = apps.get_model("marketplace", "LedgerEntry")
     stripe_amount = stripe_convert_application_to_stripe_amount(amount)
     fee = stripe_convert_stripe_to_application_fee(stripe_amount)
-    if stripe_retrieve_first_bank_account(vendor.stripe_id):
-        currency = stripe_retrieve_first_bank_account(vendor.stripe_id).get("currency")
+    if bank_account is None:
+        bank_account = stripe_retrieve_first_bank_account(vendor.stripe_id)
+    if bank_account:
+        currency = bank_account.get("currency")
     else:
         currency = None
     if currency:
         response = stripe.Payout.create(
-            amount=stripe_amount, currency=currency, stripe_account=vendor.stripe_id
+            amount=stripe_amount,
+            currency=currency,
+            stripe_account=vendor.stripe_id,
+            idempotency_key=idempotency_key,
         )
     else:
         return {
@@ -272,6 +642,9 @@ def stripe_create_payout(vendor, amount, currency):
             "message": "Vendor first needs to add approved bank account",
         }
 
+    if Payout.objects.filter(stripe_id=response.get("id")).exists():
+        # A retried request got the payout of its first attempt back
+        return response
     with atomic_transaction.atomic():
         payout = Payout.objects.create(
             currency=currency,
@@ -279,17 +652,29 @@ def stripe_create_payout(vendor, amount, currency):
             method="stripe_payout",
             fee=fee,
             amount=amount,
-            status=Payout.OMW
-            if response.get("failure_code") is not (None or "null")
-            else Payout.FAILED,
+            status=Payout.FAILED
+            if response.get("failure_code") not in (None, "null")
+            else Payout.OMW,
             data=response,
         )
         Transaction.objects.create(vendor=vendor, payout=payout, type="payout")
+        if payout.status != Payout.FAILED:
+            LedgerEntry.record_payout(vendor.pk, payout)
     return response
 
 
+@stripe_timeout("payment")
 def stripe_cancel_payout(stripe_payout_id):
+    Payout = apps.get_model("marketplace", "Payout")
+    LedgerEntry = apps.get_model("marketplace", "LedgerEntry")
     response = stripe.Payout.cancel(stripe_payout_id,)
+    payout = (
+        Payout.objects.filter(stripe_id=stripe_payout_id)
+        .annotate(ledger_vendor_id=F("transaction__vendor_id"))
+        .first()
+    )
+    if payout:
+        LedgerEntry.reverse_payout(payout.ledger_vendor_id, payout)
     return response
 
 
@@ -1,16 +1,96 @@
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
-from django.db.models import Sum
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils.functional import cached_property
 from snap.apps.marketplace.stripe import (
     stripe_create_payout,
+    stripe_retrieve_account,
     stripe_retrieve_balance,
     stripe_convert_application_to_stripe_amount,
     stripe_cancel_payout,
 )
-from snap.apps.marketplace.models import Order, Payment
+from snap.apps.marketplace.payment_models import LedgerBalance, PayoutJob
 
 logger = logging.getLogger(__name__)
 
+payout_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, "PAYOUT_VERIFY_WORKERS", 4),
+    thread_name_prefix="payout-verify",
+)
+
+
+def _close_connection_after(func, *args):
+    # Worker threads get their own database connection, don't leak it
+    try:
+        return func(*args)
+    finally:
+        connection.close()
+
+
+payout_job_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, "PAYOUT_JOB_WORKERS", 2),
+    thread_name_prefix="payout-job",
+)
+
+
+class PayoutPipeline:
+    """
+    Data needed for one payout request of a vendor.
+
+    The Stripe account, the first bank account, the Stripe balance and the
+    available payout in the application are fetched once and shared between the
+    verification and creation steps. The duration of every step is kept in
+    ``timings`` in milliseconds.
+    """
+
+    def __init__(self, vendor):
+        self.vendor = vendor
+        self.timings = {}
+
+    def timed(self, step, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.timings[step] = round((time.perf_counter() - start) * 1000, 2)
+
+    @cached_property
+    def account(self):
+        return self.timed("account", stripe_retrieve_account, self.vendor.stripe_id)
+
+    @cached_property
+    def bank_account(self):
+        account = self.account
+        if (
+            account
+            and account.get("external_accounts")
+            and account.get("external_accounts").get("data")
+        ):
+            return account.get("external_accounts").get("data")[0]
+        return None
+
+    @cached_property
+    def balance(self):
+        return self.timed("balance", stripe_retrieve_balance, self.vendor.stripe_id)
+
+    @cached_property
+    def available_payout(self):
+        return self.timed("available_payout", self.read_available_payout)
+
+    def read_available_payout(self):
+        # Completed payments minus payouts and payouts in flight, kept up to
+        # date by the ledger
+        return (
+            LedgerBalance.objects.filter(vendor=self.vendor)
+            .annotate(free=F("available") - F("reserved"))
+            .values_list("free", flat=True)
+            .first()
+        )
+
 
 class VendorBalanceWithdraw:
     """
@@ -26,20 +106,11 @@ class VendorBalanceWithdraw:
     def __init__(self, user):
         self.user = user
         self.vendor = user.vendor
+        self.pipeline = PayoutPipeline(self.vendor)
 
     def verify_application(self, amount):
         # Verify if the vendor can legit withdraw the amount that is requested.
-        available_payout = (
-            Payment.objects.filter(
-                order__status=Order.COMPLETED,
-                status=Payment.SUCCESS,
-                transaction__vendor=self.vendor,
-            )
-            .aggregate(amount=Sum("amount"))
-            .get("amount")
-        )
-        # print(amount)
-        # print(available_payout)
+        available_payout = self.pipeline.available_payout
         if not available_payout:
             return {"status": "unapproved", "message": "Account has insufficient funds"}
         if amount <= float(available_payout):
@@ -50,7 +121,7 @@ class VendorBalanceWithdraw:
             return {"status": "error", "message": "Something went wrong"}
 
     def verify_stripe(self, amount):
-        balance = stripe_retrieve_balance(self.vendor.stripe_id)
+        balance = self.pipeline.balance
         stripe_amount = stripe_convert_application_to_stripe_amount(amount)
         if balance and stripe_amount <= balance.get("amount"):
             return {"status": "approved", "message": "Payout approved"}
@@ -59,18 +130,63 @@ class VendorBalanceWithdraw:
         else:
             return {"status": "error", "message": "Something went wrong"}
 
-    def create_payout(self, amount):
+    def verify(self, amount, concurrent=False):
+        """
+        Return the application and stripe verification for the amount.
+
+        In concurrent mode the Stripe calls ( balance and bank account ) run in
+        threads while the application check runs on the database connection of
+        the caller, so it sees the data of the current transaction. When the
+        application check is unapproved we don't wait for Stripe and the stripe
+        verification is returned as None.
+        """
+        if not concurrent:
+            return self.verify_application(amount), self.verify_stripe(amount)
+
+        stripe_checks = [
+            payout_executor.submit(_close_connection_after, self.verify_stripe, amount),
+            payout_executor.submit(
+                _close_connection_after, lambda: self.pipeline.bank_account
+            ),
+        ]
+        verify_application = self.verify_application(amount)
+        if verify_application.get("status") == "unapproved":
+            return verify_application, None
+        wait(stripe_checks)
+        return verify_application, stripe_checks[0].result()
+
+    def create_payout(self, amount, *, concurrent=False, idempotency_key=None):
         float_amount = float(amount)
-        verify_application = self.verify_application(float_amount)
-        verify_stripe = self.verify_stripe(float_amount)
-        self.verify_application(float_amount)
-        if (
-            verify_application
-            and verify_application.get("status") == "approved"
-            and verify_stripe
-            and verify_stripe.get("status") == "approved"
-        ):
-            response = stripe_create_payout(self.vendor, float_amount)
+        # Every payout request starts from fresh data
+        self.pipeline = PayoutPipeline(self.vendor)
+        verify_application, verify_stripe = self.verify(float_amount, concurrent)
+        statuses = [
+            verification.get("status") if verification else None
+            for verification in (verify_application, verify_stripe)
+        ]
+        if statuses == ["approved", "approved"]:
+            # The amount is held on the ledger balance so concurrent withdrawals
+            # can't spend it twice, the Stripe call runs without the row lock
+            if not LedgerBalance.reserve(self.vendor.pk, float_amount):
+                return {
+                    "status": "unapproved",
+                    "message": "Account has insufficient funds",
+                }
+            try:
+                response = self.pipeline.timed(
+                    "create_payout",
+                    stripe_create_payout,
+                    self.vendor,
+                    float_amount,
+                    bank_account=self.pipeline.bank_account,
+                    idempotency_key=idempotency_key,
+                )
+            finally:
+                # A created payout is settled in the ledger by stripe_create_payout
+                LedgerBalance.release(self.vendor.pk, float_amount)
+            logger.info(
+                "Payout timings for vendor %s: %s", self.vendor.pk, self.pipeline.timings
+            )
             try:
                 if (
                     response
@@ -81,23 +197,77 @@ class VendorBalanceWithdraw:
                     return response
                 else:
                     stripe_cancel_payout(response.get("id"))
-                    return response
-            except Exception as e:
-                print(e)
-                pass
-        elif (
-            verify_application.get("status") == "unapproved"
-            or verify_stripe.get("status") == "unapproved"
-        ):
+                    return dict(response, status="canceled")
+            except Exception:
+                logger.exception("Could not cancel payout of vendor %s", self.vendor.pk)
+                return response
+        elif "unapproved" in statuses:
             return {"status": "unapproved", "message": "Account has insufficient funds"}
-        elif (
-            verify_application.get("status") == "error"
-            or verify_stripe.get("status") == "error"
-        ):
-            return {"status": "error", "message": "Something went wrong"}
         else:
             return {"status": "error", "message": "Something went wrong"}
 
+
+def run_payout_job(job):
+    """ Execute a claimed payout job and store its outcome """
+    try:
+        # The Stripe checks of a payout run next to the application check
+        result = VendorBalanceWithdraw(job.vendor.user).create_payout(
+            amount=job.amount, concurrent=True, idempotency_key=job.idempotency_key
+        )
+    except Exception as e:
+        logger.exception("Payout job %s failed", job.pk)
+        job.finish(error=str(e))
+    else:
+        job.finish(result=dict(result) if result else None)
+    return job
+
+
+def process_payout_jobs(limit=10, pk=None):
+    """
+    Claim and run queued payout jobs one at a time, up to ``limit`` or only
+    the job ``pk``, returns how many ran.
+    """
+    count = 0
+    while count < limit:
+        job = PayoutJob.claim(pk=pk)
+        if job is None:
+            break
+        run_payout_job(job)
+        count += 1
+    return count
+
+
+def process_submitted_payout_job(pk, limit=10):
+    """
+    Run the submitted job ``pk`` and then up to ``limit`` of the oldest queued
+    jobs, returns how many ran.
+
+    A job queued by a process that stopped before its thread ran it is picked
+    up by the next submission, so no payout request stays queued without a
+    ``run_payout_worker``.
+    """
+    return process_payout_jobs(1, pk) + process_payout_jobs(limit)
+
+
+def submit_payout_job(vendor, amount):
+    """
+    Queue a payout of the vendor and return the job.
+
+    With ``PAYOUT_JOBS_IN_PROCESS`` ( default True ) the job, and the jobs
+    still queued before it, are run by a thread of this process once the
+    request is committed. Otherwise they wait for the ``run_payout_worker``
+    command. Both claim jobs with a row lock so they can run side by side.
+    """
+    job = PayoutJob.objects.create(vendor=vendor, amount=amount)
+    if getattr(settings, "PAYOUT_JOBS_IN_PROCESS", True):
+        transaction.on_commit(
+            lambda: payout_job_executor.submit(
+                _close_connection_after, process_submitted_payout_job, job.pk
+            )
+        )
+    return job
+
+
 class BasketVendor:
     """
     Get basket of requested user.
@@ -232,6 +402,7 @@ class AddProductToBasket(APIView):
                     user=self.request.user,
                     success_url=settings.BASE_URL,
                     cancel_url=settings.BASE_URL,
+                    basket=basket,
                 )
                 data = {
                     "stripe_account_id": vendor.stripe_id,
@@ -5,92 +5,60 @@ var csrftoken = getCookie('csrftoken');
 
 
 const Pagination = ({ api_url, state, setState }) => {
-    const previousList = () => {
-        const previous = state.previous
-        if (previous !== null && 0 !== state.page_active) {
-            axios({
-                method: 'get',
-                url: previous,
-                headers: {
-                    'Authorization': localStorage.auth_token,
-                    'X-CSRFToken': csrftoken
-                },
-            })
-                .then(function (response) {
-                    setState(oldstate => {
-                        let response_data = response.data
-                        let paginated_results = {
-                            ...oldstate,
-                            next: response_data.next,
-                            previous: response_data.previous,
-                            count: response_data.count,
-                            page_active: ((response_data.page_active - 1) <= 1 ? 1 : Number(response_data.page_active) - 1),
-                            num_pages: response_data.num_pages,
-                            data: response_data.data,
-                            headers: [],
-                            url: api_url,
-                            limit: 5,
-                            explore_type: "all"
+    const loadPage = (url) => {
+        axios({
+            method: 'get',
+            url: url,
+            headers: {
+                'Authorization': localStorage.auth_token,
+                'X-CSRFToken': csrftoken
+            },
+        })
+            .then(function (response) {
+                setState(oldstate => {
+                    let response_data = response.data
+                    let paginated_results = {
+                        ...oldstate,
+                        next: response_data.links.next,
+                        previous: response_data.links.previous,
+                        count: response_data.count,
+                        count_is_approximate: response_data.count_is_approximate,
+                        data: response_data.results,
+                        headers: [],
+                        url: api_url,
+                        limit: 5,
+                        explore_type: "all"
 
-                        };
-                        return paginated_results
-                    });
+                    };
+                    return paginated_results
+                });
 
-                })
+            })
+            .catch(function (error) {
+                console.log(error)
+            });
+    };
+    const previousList = () => {
+        if (state.previous) {
+            loadPage(state.previous)
         }
     };
     const nextList = () => {
-        const next = state.next
-        if (next !== null && state.count !== state.page_active) {
-            axios({
-                method: 'get',
-                url: next,
-                headers: {
-                    'Authorization': localStorage.auth_token,
-                    'X-CSRFToken': csrftoken
-                },
-            })
-                .then(function (response) {
-                    setState(oldstate => {
-                        let response_data = response.data
-                        let paginated_results = {
-                            ...oldstate,
-                            next: response_data.next,
-                            previous: response_data.previous,
-                            count: response_data.count,
-                            page_active: Number(response_data.page_active) + 1,
-                            num_pages: response_data.num_pages,
-                            data: response_data.data,
-                            headers: [],
-                            url: api_url,
-                            limit: 5,
-                            explore_type: "all"
-
-                        };
-                        return paginated_results
-                    });
-
-                })
-                .catch(function (error) {
-                    console.log(error)
-                });
-
-        } else {
-            null
+        if (state.next) {
+            loadPage(state.next)
         }
     };
 
-    const pageItem = () => {
-        if (state && state.num_pages) {
-            let pagi = state.num_pages.map(item => (
-                <li key={item} className={`page-item ${state.page_active === item ?
-                    'active' : ''}`}>
+    const countItem = () => {
+        if (state && state.count !== undefined) {
+            // The campaign list is cursor paginated, there are no page numbers
+            return (
+                <li className="page-item disabled">
                     <div className="page-link">
-                        {item}
+                        {state.count}{state.count_is_approximate ? '+' : ''} results
                     </div>
                 </li>
-            ))
-            return pagi
+            )
         } else {
             return null
         }
@@ -100,14 +68,14 @@ const Pagination = ({ api_url, state, setState }) => {
         <>
             <nav aria-label="Page navigation example">
                 <ul className="pagination">
-                    <li className="page-item">
+                    <li className={`page-item ${state.previous ? '' : 'disabled'}`}>
                         <div onClick={previousList} className="page-link page-link-arrow" aria-label="Previous">
                             <span aria-hidden="true">&laquo;</span>
                             <span className="sr-only">Previous</span>
                         </div>
                     </li>
-                    {pageItem()}
-                    <li className="page-item">
+                    {countItem()}
+                    <li className={`page-item ${state.next ? '' : 'disabled'}`}>
                         <div onClick={nextList} className="page-link page-link-arrow" aria-label="Next">
                             <span aria-hidden="true">&raquo;</span>
                             <span className="sr-only">Next</span>
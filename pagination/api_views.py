@@ -1,39 +1,156 @@
+from django.db import transaction
+from rest_framework import serializers, status
 from rest_framework.response import Response
 from rest_framework.generics import ListAPIView
 from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.authentication import SessionAuthentication
+from rest_framework.permissions import IsAuthenticated
 
 from influencer.apps.marketing.models import Campaign
-from influencer.apps.users.models import User
+from influencer.apps.users.authentication import CachedTokenAuthentication
 from influencer.apps.marketing.serializers import CampaignSerializer
-from influencer.apps.marketing.pagination import StandardResultsSetPagination
+from influencer.apps.marketing.pagination import KeysetPagination
 4
 
+class BulkCampaignIdSerializer(serializers.Serializer):
+    id = serializers.IntegerField(required=False, allow_null=True, min_value=1)
+
+
 class CampaignListApiView(ListAPIView):    
     serializer_class = CampaignSerializer
-    pagination_class = StandardResultsSetPagination
+    pagination_class = KeysetPagination
+    authentication_classes = [CachedTokenAuthentication, SessionAuthentication]
+    permission_classes = [IsAuthenticated]
     search_fields = ["name"]
     filter_backends = [
         SearchFilter,
         OrderingFilter
     ]
     def get_queryset(self):
-        if self.request.headers.get("Authorization"):
-            user = User.objects.get(auth_token=self.request.headers.get("Authorization"))
-        else:
-            user = self.request.user
-        return Campaign.objects.filter(user=user).order_by('id')
+        return Campaign.objects.filter(user=self.request.user).order_by('id')
+
+    @staticmethod
+    def split_validated_data(validated_data):
+        """ Column values and many-to-many values of a validated campaign """
+        fields, many_to_many = {}, {}
+        for name, value in validated_data.items():
+            if Campaign._meta.get_field(name).many_to_many:
+                many_to_many[name] = value
+            else:
+                fields[name] = value
+        return fields, many_to_many
+
+    def bulk_post(self, request, items):
+        """
+        Create or update a list of campaigns in one transaction.
+
+        Every item is validated first, when one of them is invalid nothing is
+        written and the errors are returned per item, the other items are
+        reported as "valid". Items with an id update that campaign of the user,
+        an id can only be used once per list. The others are created. Both are
+        built from the validated data and written with ``bulk_create`` and
+        ``bulk_update``, many-to-many values are set once the rows exist. The
+        created and updated statuses are only reported once written.
+        """
+        user = request.user
+        context = {"request": request, "user": user}
+        errors = {}
+        validated = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                errors[index] = {"status": "invalid", "errors": ["Expected an object."]}
+                continue
+            id_serializer = BulkCampaignIdSerializer(data=item)
+            serializer = CampaignSerializer(data=item, context=context)
+            id_is_valid = id_serializer.is_valid()
+            item_is_valid = serializer.is_valid()
+            if not (id_is_valid and item_is_valid):
+                errors[index] = {
+                    "status": "invalid",
+                    "errors": {**serializer.errors, **id_serializer.errors},
+                }
+                continue
+            validated.append((index, id_serializer.validated_data.get("id"), serializer))
+
+        existing = Campaign.objects.filter(user=user).in_bulk(
+            [campaign_id for _, campaign_id, _ in validated if campaign_id]
+        )
+        to_create = []
+        to_update = []
+        many_to_many = []
+        update_fields = set()
+        seen_ids = set()
+        for index, campaign_id, serializer in validated:
+            fields, related = self.split_validated_data(serializer.validated_data)
+            if campaign_id is None:
+                campaign = Campaign(**{**fields, "user": user})
+                to_create.append((index, campaign))
+            elif campaign_id in seen_ids:
+                errors[index] = {
+                    "status": "invalid",
+                    "errors": {"id": ["This campaign is already in the list."]},
+                }
+                continue
+            else:
+                seen_ids.add(campaign_id)
+                campaign = existing.get(campaign_id)
+                if campaign is None:
+                    errors[index] = {"status": "not_found"}
+                    continue
+                for field, value in fields.items():
+                    setattr(campaign, field, value)
+                update_fields.update(fields)
+                to_update.append((index, campaign))
+            if related:
+                many_to_many.append((campaign, related))
+
+        if errors:
+            return Response(
+                status=status.HTTP_400_BAD_REQUEST,
+                data=[
+                    {"index": index, **errors.get(index, {"status": "valid"})}
+                    for index in range(len(items))
+                ],
+            )
+
+        with transaction.atomic():
+            Campaign.objects.bulk_create(
+                [campaign for _, campaign in to_create], batch_size=500
+            )
+            if to_update and update_fields:
+                Campaign.objects.bulk_update(
+                    [campaign for _, campaign in to_update],
+                    sorted(update_fields),
+                    batch_size=500,
+                )
+            for campaign, related in many_to_many:
+                for field, value in related.items():
+                    getattr(campaign, field).set(value)
+
+        results = [
+            {"index": index, "status": item_status, "campaign": campaign}
+            for item_status, written in (
+                ("created", to_create),
+                ("updated", to_update),
+            )
+            for index, campaign in written
+        ]
+        results.sort(key=lambda result: result["index"])
+        for result in results:
+            result["campaign"] = CampaignSerializer(
+                result["campaign"], context=context
+            ).data
+        return Response(results)
 
     def post(self, request):
-        if self.request.headers.get("Authorization"):
-            user = User.objects.get(auth_token=self.request.headers.get("Authorization"))
-        else:
-            user = self.request.user
+        user = request.user
+        if isinstance(request.data, list):
+            return self.bulk_post(request, request.data)
         if user:
             if not request.data.get("id"):
                 serializer = CampaignSerializer(data=request.data, context={"request" : request, "user": user})
                 if serializer.is_valid():
                     campaign = serializer.create(validated_data=serializer.validated_data)
-                    campaign.save()
                     return Response(CampaignSerializer(campaign).data)
                 return Response(
                     status=status.HTTP_400_BAD_REQUEST,
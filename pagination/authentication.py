@@ -0,0 +1,109 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from influencer.apps.users.models import User
+
+
+class LocalTTLCache:
+    """ Small in-process LRU cache with a time to live per entry """
+
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+local_token_cache = LocalTTLCache()
+
+
+def _token_cache_key(key):
+    return "auth:token:%s" % key
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Token authentication backed by an in-process and a shared cache.
+
+    The user of a token is looked up once and kept in the process for a short
+    time and in the shared cache for longer. Rotating or deleting a token, or
+    saving its user, removes the cached entry. Other processes can still use
+    their local entry for at most ``LocalTTLCache.ttl`` seconds.
+
+    Both ``Authorization: Token <key>`` and a bare ``Authorization: <key>``
+    header are accepted, the frontend sends the bare key.
+    """
+
+    shared_ttl = 60 * 5
+
+    def authenticate(self, request):
+        auth = request.headers.get("Authorization", "").split()
+        if len(auth) == 2 and auth[0].lower() == self.keyword.lower():
+            return self.authenticate_credentials(auth[1])
+        if len(auth) == 1:
+            return self.authenticate_credentials(auth[0])
+        return None
+
+    def authenticate_credentials(self, key):
+        user = local_token_cache.get(key)
+        if user is None:
+            user = cache.get(_token_cache_key(key))
+            if user is None:
+                token = Token.objects.select_related("user").filter(key=key).first()
+                if token is None:
+                    raise exceptions.AuthenticationFailed("Invalid token.")
+                user = token.user
+                cache.set(_token_cache_key(key), user, self.shared_ttl)
+            local_token_cache.set(key, user)
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed("User inactive or deleted.")
+        return (user, key)
+
+
+def invalidate_token(key):
+    local_token_cache.delete(key)
+    cache.delete(_token_cache_key(key))
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def token_invalidate_cache(sender, instance, **kwargs):
+    invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=User)
+def user_invalidate_token_cache(sender, instance, **kwargs):
+    token = Token.objects.filter(user=instance).values_list("key", flat=True).first()
+    if token:
+        invalidate_token(token)
@@ -0,0 +1,180 @@
+import base64
+import json
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset ( cursor ) pagination on indexed columns.
+
+    A page is selected with a WHERE on the ordering columns of the last row that
+    was seen instead of an OFFSET, so deep pages are as cheap as the first one.
+    The ordering is taken from the queryset ( for example set by OrderingFilter )
+    and always ends with the primary key to make it unique. Only non-null
+    columns of the model can be compared with a cursor, any other ordering
+    falls back to ``ordering``.
+
+    Cursors are opaque base64 strings. The count is approximate: counting stops
+    at ``count_limit`` rows and ``count_is_approximate`` tells if it did.
+    """
+
+    page_size = 20
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    cursor_query_param = "cursor"
+    ordering = ("-id",)
+    count_limit = 1000
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    @staticmethod
+    def is_keyset_field(model, name):
+        if name == "pk":
+            return True
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return False
+        return field.concrete and not field.is_relation and not field.null
+
+    def get_ordering(self, queryset):
+        ordering = tuple(
+            field for field in queryset.query.order_by if isinstance(field, str)
+        )
+        if not ordering or not all(
+            self.is_keyset_field(queryset.model, field.lstrip("-"))
+            for field in ordering
+        ):
+            ordering = tuple(self.ordering)
+        if ordering[-1].lstrip("-") not in ("id", "pk"):
+            ordering = ordering + ("-id" if ordering[-1].startswith("-") else "id",)
+        return ordering
+
+    def encode_cursor(self, row, reverse):
+        position = [
+            str(self._value(row, field.lstrip("-"))) for field in self.ordering
+        ]
+        cursor = json.dumps({"p": position, "o": self.ordering, "r": reverse})
+        return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+        except (TypeError, ValueError):
+            return None, False
+        if not isinstance(cursor, dict):
+            return None, False
+        position = cursor.get("p")
+        # A cursor of another ordering starts from the first page again
+        if (
+            not isinstance(cursor.get("o"), list)
+            or tuple(cursor["o"]) != self.ordering
+            or not isinstance(position, list)
+            or len(position) != len(self.ordering)
+        ):
+            return None, False
+        return position, bool(cursor.get("r"))
+
+    @staticmethod
+    def _reverse_field(field):
+        return field[1:] if field.startswith("-") else "-" + field
+
+    @staticmethod
+    def _value(row, field):
+        if isinstance(row, dict):
+            return row[field]
+        return getattr(row, field)
+
+    def keyset_filter(self, position, reverse):
+        """
+        Rows after the position in the ordering:
+        (a > x) OR (a = x AND b > y) OR ...
+        """
+        query = Q()
+        equal = Q()
+        for field, value in zip(self.ordering, position):
+            name = field.lstrip("-")
+            descending = field.startswith("-") != reverse
+            lookup = "%s__%s" % (name, "lt" if descending else "gt")
+            query |= equal & Q(**{lookup: value})
+            equal &= Q(**{name: value})
+        return query
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = getattr(view, "page_size", self.page_size)
+        self.max_page_size = getattr(view, "max_page_size", self.max_page_size)
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(queryset)
+        position, reverse = self.decode_cursor(request)
+
+        self.count = queryset.order_by()[: self.count_limit + 1].count()
+        self.count_is_approximate = self.count > self.count_limit
+        self.count = min(self.count, self.count_limit)
+
+        if reverse:
+            queryset = queryset.order_by(
+                *[self._reverse_field(field) for field in self.ordering]
+            )
+        else:
+            queryset = queryset.order_by(*self.ordering)
+        if position:
+            try:
+                queryset = queryset.filter(self.keyset_filter(position, reverse))
+            except (TypeError, ValueError, ValidationError):
+                # A tampered cursor with values of the wrong type
+                position, reverse = None, False
+                queryset = queryset.order_by(*self.ordering)
+
+        rows = list(queryset[: self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        rows = rows[: self.page_size]
+        if reverse:
+            rows.reverse()
+            self.has_next, self.has_previous = bool(position), has_more
+        else:
+            self.has_next, self.has_previous = has_more, bool(position)
+        self.page = rows
+        return rows
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url, self.cursor_query_param, self.encode_cursor(self.page[-1], False)
+        )
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url, self.cursor_query_param, self.encode_cursor(self.page[0], True)
+        )
+
+    def get_paginated_response(self, data):
+        return Response(
+            {
+                "links": {
+                    "next": self.get_next_link(),
+                    "previous": self.get_previous_link(),
+                },
+                "count": self.count,
+                "count_is_approximate": self.count_is_approximate,
+                "results": data,
+            }
+        )
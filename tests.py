@@ -92,8 +92,89 @@ from tests.factories.marketplace.models import (
     TransactionFactory,
 )
 from tests.factories.vendor.models import VendorFactory
+import base64
+import datetime
+import json
 import mock
-from snap.apps.vendor.utils import VendorBalanceWithdraw
+import threading
+import stripe
+from django.contrib.auth.models import AnonymousUser
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from tests.factories.catalogue.models import (
+    CategoryFactory,
+    ProductFactory,
+    ProductImageFactory,
+    ProductReviewFactory,
+)
+from snap.apps.catalogue.models import (
+    DailyIncome,
+    Product,
+    ProductRatingSummary,
+    ProductSearchDocument,
+)
+from oscar.core.loading import get_model
+
+ProductAttributeValue = get_model("catalogue", "ProductAttributeValue")
+from snap.apps.catalogue.serializers import ProductSerializer, ProductVariantLoader
+from snap.apps.marketplace.models import Payout, Transaction
+from snap.apps.marketplace.payment_models import (
+    LedgerBalance,
+    LedgerEntry,
+    PayoutJob,
+    StripeEvent,
+    VendorOperation,
+)
+from django.core.cache import cache
+from snap.apps.marketplace.api_views import (
+    DashboardBalanceApiView,
+    DashboardOperationsApiView,
+    IncomeTrackerApiView,
+    MainDashboardApiView,
+    ProductApiView,
+    ReviewSectionApiView,
+    StripeWebhookApiView,
+    stream_products,
+)
+from snap.apps.marketplace.cache import (
+    bump_vendor_cache_version,
+    vendor_response_cache,
+)
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from snap.apps.vendor.utils import (
+    VendorBalanceWithdraw,
+    process_payout_jobs,
+    process_submitted_payout_job,
+    submit_payout_job,
+)
+from rest_framework.request import Request
+from influencer.apps.marketing.pagination import KeysetPagination
+from influencer.apps.users.authentication import CachedTokenAuthentication
+from influencer.apps.marketing.api_views import CampaignListApiView
+from influencer.apps.marketing.models import Campaign
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+from snap.apps.marketplace.stripe import (
+    STRIPE_TIMEOUTS,
+    StripeAccountCache,
+    account_cache,
+    retrieve_stripe_account,
+    stripe_accounts_updated,
+    stripe_checkout_session_create,
+    stripe_connected_ecommerce,
+    stripe_get_account_link_type,
+    stripe_ingest_event,
+    stripe_charge_create,
+    stripe_checkout_session_completed,
+    stripe_process_pending_events,
+    stripe_retrieve_balance,
+    stripe_retrieve_first_bank_account,
+)
 
 stripe_balance_mock_data = {
     "object": "balance",
@@ -185,8 +266,1225 @@ def test_create_payout(payout_response, balance_response):
     payment = PaymentFactory(status="success", order=order, amount=20)
     TransactionFactory(vendor=vendor, payment=payment)
     vendor_balance_withdraw = VendorBalanceWithdraw(user=vendor.user)
-    assert vendor_balance_withdraw.create_payout(20.00, "eur")
-    assert vendor_balance_withdraw.create_payout(20.00, "eur").get("amount") == 2000
+    assert vendor_balance_withdraw.create_payout(20.00).get("amount") == 2000
+    # The ledger balance was paid out by the first payout
+    assert vendor_balance_withdraw.create_payout(20.00).get("status") == "unapproved"
+    assert payout_response.call_count == 1
+
+
+stripe_account_mock_data = {
+    "id": "abc123",
+    "object": "account",
+    "email": "vendor@crimzon.nl",
+    "payouts_enabled": True,
+    "external_accounts": {
+        "object": "list",
+        "data": [{"id": "ba_123", "object": "bank_account", "currency": "eur"}],
+    },
+}
+
+
+@pytest.mark.django_db
+def test_stripe_calls_use_their_own_timeout(settings):
+    settings.STRIPE_HTTP_TIMEOUTS = {"read": (1, 2)}
+    client = stripe.default_http_client
+    default_timeout = client._timeout
+    timeouts = {}
+
+    def _balance(**kwargs):
+        timeouts["balance"] = client._timeout
+        return stripe_balance_mock_data
+
+    def _charge(**kwargs):
+        timeouts["charge"] = client._timeout
+        return kwargs
+
+    with mock.patch("stripe.Balance.retrieve", side_effect=_balance):
+        stripe_retrieve_balance("abc123")
+    with mock.patch("stripe.Charge.create", side_effect=_charge):
+        charge = stripe_charge_create(2000, 200, "abc123")
+
+    assert timeouts["balance"] == (1, 2)
+    assert timeouts["charge"] == STRIPE_TIMEOUTS["payment"]
+    assert client._timeout == default_timeout
+    # Stripe's library adds its own key to retries of a call without one
+    assert charge["idempotency_key"] is None
+
+
+@mock.patch("stripe.Account.retrieve", return_value=stripe_account_mock_data)
+@pytest.mark.django_db
+def test_stripe_account_cache_single_retrieve(account_response):
+    account_cache.clear()
+    vendor = VendorFactory(stripe_id="abc123")
+
+    assert stripe_connected_ecommerce(vendor)
+    assert stripe_get_account_link_type(vendor) == "account_update"
+    assert stripe_retrieve_first_bank_account(vendor.stripe_id).get("id") == "ba_123"
+    assert account_response.call_count == 1
+
+
+@mock.patch("stripe.Account.retrieve", return_value=stripe_account_mock_data)
+@pytest.mark.django_db
+def test_stripe_account_cache_is_shared_between_processes(account_response):
+    account_cache.clear()
+    other_process_cache = StripeAccountCache()
+
+    assert other_process_cache.retrieve("abc123") == stripe_account_mock_data
+    assert account_cache.retrieve("abc123") == stripe_account_mock_data
+    assert account_response.call_count == 1
+
+    account_cache.invalidate("abc123")
+    other_process_cache.retrieve("abc123")
+    assert account_response.call_count == 2
+
+
+@mock.patch("stripe.Account.retrieve", return_value=stripe_account_mock_data)
+@pytest.mark.django_db
+def test_stripe_accounts_updated_replaces_cached_account(account_response):
+    account_cache.clear()
+    vendor = VendorFactory(stripe_id="abc123")
+    retrieve_stripe_account(vendor)
+    updated_account = dict(stripe_account_mock_data, payouts_enabled=False)
+
+    assert stripe_accounts_updated({"abc123": updated_account}) == {vendor.pk}
+    vendor.refresh_from_db()
+
+    assert vendor.stripe_account.get("payouts_enabled") is False
+    assert not stripe_connected_ecommerce(vendor)
+    assert account_response.call_count == 1
+
+
+@pytest.mark.django_db
+def test_stripe_events_are_deduplicated_and_processed_in_batch(settings):
+    settings.STRIPE_EVENTS_IN_PROCESS = False
+    account_cache.clear()
+    vendor = VendorFactory(stripe_id="abc123")
+
+    def _event(event_id, created, payouts_enabled):
+        account = dict(stripe_account_mock_data, payouts_enabled=payouts_enabled)
+        return {
+            "id": event_id,
+            "type": "account.updated",
+            "created": created,
+            "data": {"object": account},
+        }
+
+    stripe_ingest_event(_event("evt_1", 1600000000, True))
+    stripe_ingest_event(_event("evt_2", 1600000100, False))
+    stripe_ingest_event(_event("evt_2", 1600000100, False))
+    assert StripeEvent.objects.count() == 2
+
+    assert stripe_process_pending_events() == 2
+    assert stripe_process_pending_events() == 0
+    vendor.refresh_from_db()
+    assert vendor.stripe_account.get("payouts_enabled") is False
+    assert not StripeEvent.objects.filter(processed__isnull=True).exists()
+
+
+@pytest.mark.django_db
+def test_stripe_webhook_stores_only_verified_events(settings):
+    settings.STRIPE_EVENTS_IN_PROCESS = False
+    settings.STRIPE_WEBHOOK_SECRET = "whsec_test"
+    event = {
+        "id": "evt_webhook",
+        "type": "account.updated",
+        "created": 1600000000,
+        "data": {"object": stripe_account_mock_data},
+    }
+
+    def _post(signature):
+        request = APIRequestFactory().post(
+            "/api/stripe/webhook/",
+            data=json.dumps(event),
+            content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=signature,
+        )
+        return StripeWebhookApiView.as_view()(request)
+
+    with mock.patch(
+        "stripe.Webhook.construct_event",
+        side_effect=stripe.error.SignatureVerificationError("Bad signature", "bad"),
+    ) as construct_event:
+        assert _post("bad").status_code == 400
+    assert construct_event.call_args.args[1:] == ("bad", "whsec_test")
+    assert not StripeEvent.objects.exists()
+
+    with mock.patch("stripe.Webhook.construct_event", return_value=event):
+        assert _post("good").status_code == 200
+    stored = StripeEvent.objects.get()
+    assert stored.stripe_id == "evt_webhook"
+    assert stored.object_id == stripe_account_mock_data["id"]
+    assert stored.processed is None
+
+
+@mock.patch("stripe.Account.retrieve", return_value=stripe_account_mock_data)
+@mock.patch("stripe.Payout.create", return_value=stripe_response_payout)
+@mock.patch("stripe.Balance.retrieve", return_value=stripe_balance_mock_data)
+@pytest.mark.django_db
+def test_stripe_failed_payout_event_reverses_the_payout(
+    balance_response, payout_response, account_response, settings
+):
+    settings.STRIPE_EVENTS_IN_PROCESS = False
+    account_cache.clear()
+    vendor = VendorFactory(stripe_id="abc123")
+    TransactionFactory(
+        vendor=vendor,
+        payment=PaymentFactory(
+            status="success", order=OrderFactory(status="completed"), amount=20
+        ),
+    )
+    VendorBalanceWithdraw(user=vendor.user).create_payout(20.00)
+    payout = Payout.objects.get(stripe_id=stripe_response_payout["id"])
+    assert _ledger(vendor) == (0, 0, 20, 0)
+
+    for event_id, status in (("evt_failed", "failed"), ("evt_canceled", "canceled")):
+        stripe_ingest_event(
+            {
+                "id": event_id,
+                "type": "payout.%s" % status,
+                "created": 1600000000,
+                "data": {"object": dict(stripe_response_payout, status=status)},
+            }
+        )
+        assert stripe_process_pending_events() == 1
+
+    # The payout is reversed once, however many events report it
+    payout.refresh_from_db()
+    assert payout.status == Payout.FAILED
+    assert _ledger(vendor) == (20, 0, 0, 0)
+    assert (
+        LedgerEntry.objects.filter(
+            payout=payout, kind=LedgerEntry.PAYOUT_REVERSED
+        ).count()
+        == 1
+    )
+    assert VendorOperation.objects.get(transaction__payout=payout).status == (
+        Payout.FAILED
+    )
+    assert not StripeEvent.objects.filter(error__isnull=False).exists()
+
+
+def _ledger(vendor):
+    balance = LedgerBalance.objects.get(vendor=vendor)
+    return balance.available, balance.pending, balance.paid_out, balance.reserved
+
+
+@pytest.mark.django_db
+def test_ledger_sync_payment_is_idempotent_and_reversed():
+    vendor = VendorFactory()
+    order = OrderFactory(status="pending")
+    payment = PaymentFactory(status="pending", order=order, amount=20)
+    TransactionFactory(vendor=vendor, payment=payment)
+    payment.save()
+    assert _ledger(vendor) == (0, 20, 0, 0)
+
+    payment.status = "success"
+    payment.save()
+    order.status = "completed"
+    order.save()
+    order.save()
+    assert _ledger(vendor) == (20, 0, 0, 0)
+
+    # Amount changes of the completed payment are adjusted, each once
+    payment.amount = 25
+    payment.save()
+    payment.save()
+    assert _ledger(vendor) == (25, 0, 0, 0)
+    payment.amount = 15
+    payment.save()
+    assert _ledger(vendor) == (15, 0, 0, 0)
+
+    # The order leaves completed, the payment no longer counts as available
+    order.status = "pending"
+    order.save()
+    assert _ledger(vendor) == (0, 0, 0, 0)
+    assert sorted(
+        LedgerEntry.objects.filter(payment=payment).values_list("kind", flat=True)
+    ) == sorted(
+        [
+            LedgerEntry.PAYMENT_PENDING,
+            LedgerEntry.PAYMENT_PENDING_CLEARED,
+            LedgerEntry.PAYMENT_COMPLETED,
+            LedgerEntry.PAYMENT_ADJUSTED,
+            LedgerEntry.PAYMENT_ADJUSTED,
+            LedgerEntry.PAYMENT_REVERSED,
+        ]
+    )
+
+
+@pytest.mark.django_db
+def test_dashboard_balance_reads_the_ledger():
+    cache.clear()
+    vendor = VendorFactory()
+
+    def _balance():
+        request = APIRequestFactory().get("/api/dashboard/balance/")
+        force_authenticate(request, user=vendor.user)
+        cache.clear()
+        return DashboardBalanceApiView.as_view()(request).data
+
+    assert _balance()["balance"] == 0
+    TransactionFactory(
+        vendor=vendor,
+        payment=PaymentFactory(
+            status="success", order=OrderFactory(status="completed"), amount=20
+        ),
+    )
+    assert LedgerBalance.reserve(vendor.pk, 5)
+
+    data = _balance()
+    assert data["balance"] == 20
+    assert data["available_payout"] == 15
+    assert data["pending"] == 0
+    assert data["paid_out"] == 0
+
+
+@mock.patch("stripe.Account.retrieve", return_value=stripe_account_mock_data)
+@mock.patch("stripe.Payout.create", return_value=stripe_response_payout)
+@mock.patch("stripe.Balance.retrieve", return_value=stripe_balance_mock_data)
+@pytest.mark.django_db
+def test_backfill_ledger_records_every_payment_and_payout_once(
+    balance_response, payout_response, account_response
+):
+    account_cache.clear()
+    vendor = VendorFactory(stripe_id="abc123")
+    TransactionFactory(
+        vendor=vendor,
+        payment=PaymentFactory(
+            status="success", order=OrderFactory(status="completed"), amount=20
+        ),
+    )
+    TransactionFactory(
+        vendor=vendor,
+        payment=PaymentFactory(
+            status="pending", order=OrderFactory(status="pending"), amount=5
+        ),
+    )
+    VendorBalanceWithdraw(user=vendor.user).create_payout(20.00)
+    # A payout that failed right away but was stored as on its way
+    failed_payout = Payout.objects.create(
+        currency="usd",
+        stripe_id="po_failed",
+        method="stripe_payout",
+        fee=0,
+        amount=5,
+        status=Payout.OMW,
+        data={"id": "po_failed", "failure_code": "account_closed"},
+    )
+    Transaction.objects.create(vendor=vendor, payout=failed_payout, type="payout")
+    # History from before the ledger existed
+    LedgerEntry.objects.filter(vendor=vendor).delete()
+    LedgerBalance.objects.filter(vendor=vendor).delete()
+
+    # A vendor of which only the newest payment reached the ledger
+    other_vendor = VendorFactory()
+    old_payment = PaymentFactory(
+        status="success", order=OrderFactory(status="completed"), amount=10
+    )
+    TransactionFactory(vendor=other_vendor, payment=old_payment)
+    TransactionFactory(
+        vendor=other_vendor,
+        payment=PaymentFactory(
+            status="success", order=OrderFactory(status="completed"), amount=30
+        ),
+    )
+    LedgerEntry.objects.filter(payment=old_payment).delete()
+    LedgerBalance.objects.filter(vendor=other_vendor).update(
+        available=F("available") - 10
+    )
+
+    call_command("backfill_ledger")
+    call_command("backfill_ledger")
+
+    assert _ledger(vendor) == (0, 5, 20, 0)
+    assert LedgerEntry.objects.filter(vendor=vendor).count() == 3
+    assert _ledger(other_vendor) == (40, 0, 0, 0)
+
+
+@mock.patch("stripe.Account.retrieve", return_value=stripe_account_mock_data)
+@mock.patch("stripe.Balance.retrieve", return_value=stripe_balance_mock_data)
+@pytest.mark.django_db
+def test_create_payout_reserves_the_amount_during_the_stripe_call(
+    balance_response, account_response
+):
+    account_cache.clear()
+    vendor = VendorFactory(stripe_id="abc123")
+    TransactionFactory(
+        vendor=vendor,
+        payment=PaymentFactory(
+            status="success", order=OrderFactory(status="completed"), amount=20
+        ),
+    )
+    vendor_balance_withdraw = VendorBalanceWithdraw(user=vendor.user)
+    during_call = []
+
+    def _payout(**kwargs):
+        during_call.append(_ledger(vendor))
+        return stripe_response_payout
+
+    # Another withdrawal holds part of the balance
+    assert LedgerBalance.reserve(vendor.pk, 15)
+    with mock.patch("stripe.Payout.create", side_effect=_payout) as payout_response:
+        assert (
+            vendor_balance_withdraw.create_payout(20.00).get("status") == "unapproved"
+        )
+        assert not payout_response.called
+
+        LedgerBalance.release(vendor.pk, 15)
+        assert vendor_balance_withdraw.create_payout(20.00).get("amount") == 2000
+
+    assert during_call == [(20, 0, 0, 20)]
+    assert _ledger(vendor) == (0, 0, 20, 0)
+
+
+@mock.patch("stripe.Account.retrieve", return_value=stripe_account_mock_data)
+@mock.patch("stripe.Payout.create", return_value=stripe_response_payout)
+@mock.patch("stripe.Balance.retrieve", return_value=stripe_balance_mock_data)
+@pytest.mark.django_db
+def test_create_payout_fetches_stripe_data_once(
+    balance_response, payout_response, account_response
+):
+    account_cache.clear()
+    vendor = VendorFactory(stripe_id="abc123")
+    order = OrderFactory(status="completed")
+    payment = PaymentFactory(status="success", order=order, amount=20)
+    TransactionFactory(vendor=vendor, payment=payment)
+    vendor_balance_withdraw = VendorBalanceWithdraw(user=vendor.user)
+
+    assert vendor_balance_withdraw.create_payout(20.00, concurrent=False).get("amount") == 2000
+    assert balance_response.call_count == 1
+    assert account_response.call_count == 1
+    assert set(vendor_balance_withdraw.pipeline.timings) == {
+        "available_payout",
+        "balance",
+        "account",
+        "create_payout",
+    }
+
+
+@mock.patch("stripe.Account.retrieve", return_value=stripe_account_mock_data)
+@mock.patch("stripe.Payout.create", return_value=stripe_response_payout)
+@mock.patch("stripe.Balance.retrieve", return_value=stripe_balance_mock_data)
+@pytest.mark.django_db
+def test_create_payout_concurrent(balance_response, payout_response, account_response):
+    account_cache.clear()
+    vendor = VendorFactory(stripe_id="abc123")
+    order = OrderFactory(status="completed")
+    payment = PaymentFactory(status="success", order=order, amount=20)
+    TransactionFactory(vendor=vendor, payment=payment)
+    vendor_balance_withdraw = VendorBalanceWithdraw(user=vendor.user)
+
+    assert vendor_balance_withdraw.create_payout(20.00, concurrent=True).get("amount") == 2000
+    assert payout_response.call_count == 1
+
+
+@mock.patch("stripe.Account.retrieve", return_value=stripe_account_mock_data)
+@mock.patch("stripe.Payout.create", return_value=stripe_response_payout)
+@mock.patch("stripe.Balance.retrieve", return_value=stripe_balance_mock_data)
+@pytest.mark.django_db(transaction=True)
+def test_payout_job_runs_in_worker(
+    balance_response, payout_response, account_response, settings
+):
+    settings.PAYOUT_JOBS_IN_PROCESS = False
+    account_cache.clear()
+    vendor = VendorFactory(stripe_id="abc123")
+    order = OrderFactory(status="completed")
+    payment = PaymentFactory(status="success", order=order, amount=20)
+    TransactionFactory(vendor=vendor, payment=payment)
+
+    job = submit_payout_job(vendor, 20)
+    assert job.status == PayoutJob.QUEUED
+    with mock.patch.object(
+        VendorBalanceWithdraw,
+        "verify",
+        autospec=True,
+        side_effect=VendorBalanceWithdraw.verify,
+    ) as verify:
+        assert process_payout_jobs() == 1
+    assert process_payout_jobs() == 0
+    # Jobs verify the payout with the Stripe checks in parallel
+    assert verify.call_args.args[2] is True
+
+    job.refresh_from_db()
+    assert job.status == PayoutJob.SUCCEEDED
+    assert job.result.get("amount") == 2000
+    assert job.attempts == 1
+    assert payout_response.call_args.kwargs["idempotency_key"] == job.idempotency_key
+
+
+@mock.patch("stripe.Payout.cancel")
+@mock.patch("stripe.Account.retrieve", return_value=stripe_account_mock_data)
+@mock.patch("stripe.Payout.create", return_value=stripe_response_payout)
+@mock.patch("stripe.Balance.retrieve", return_value=stripe_balance_mock_data)
+@pytest.mark.django_db
+def test_payout_jobs_are_claimed_one_by_one_and_finished_once(
+    balance_response, payout_response, account_response, cancel_response, settings
+):
+    settings.PAYOUT_JOBS_IN_PROCESS = False
+    account_cache.clear()
+    vendor = VendorFactory(stripe_id="abc123")
+    TransactionFactory(
+        vendor=vendor,
+        payment=PaymentFactory(
+            status="success", order=OrderFactory(status="completed"), amount=30
+        ),
+    )
+    first_job = submit_payout_job(vendor, 20)
+    second_job = submit_payout_job(vendor, 20)
+
+    # The submitted job is run, not the oldest queued one
+    assert process_payout_jobs(pk=second_job.pk) == 1
+    first_job.refresh_from_db()
+    second_job.refresh_from_db()
+    assert first_job.status == PayoutJob.QUEUED
+    assert second_job.status == PayoutJob.SUCCEEDED
+
+    # A finished job keeps its outcome
+    second_job.finish(result={"status": "unapproved"})
+    second_job.refresh_from_db()
+    assert second_job.status == PayoutJob.SUCCEEDED
+
+    # Running jobs are never claimed again
+    PayoutJob.objects.filter(pk=first_job.pk).update(status=PayoutJob.RUNNING)
+    assert PayoutJob.claim() is None
+
+    # The payout of Stripe doesn't match the job, it is canceled
+    payout_response.return_value = dict(stripe_response_payout, id="po_canceled")
+    canceled_job = submit_payout_job(vendor, 10)
+    assert process_payout_jobs() == 1
+    canceled_job.refresh_from_db()
+    assert cancel_response.called
+    assert canceled_job.status == PayoutJob.FAILED
+    assert canceled_job.result.get("status") == "canceled"
+
+
+@mock.patch("stripe.Account.retrieve", return_value=stripe_account_mock_data)
+@mock.patch("stripe.Payout.create", return_value=stripe_response_payout)
+@mock.patch("stripe.Balance.retrieve", return_value=stripe_balance_mock_data)
+@pytest.mark.django_db(transaction=True)
+def test_payout_job_in_process_also_runs_jobs_left_queued(
+    balance_response, payout_response, account_response, settings
+):
+    settings.PAYOUT_JOBS_IN_PROCESS = True
+    account_cache.clear()
+    vendor = VendorFactory(stripe_id="abc123")
+    TransactionFactory(
+        vendor=vendor,
+        payment=PaymentFactory(
+            status="success", order=OrderFactory(status="completed"), amount=40
+        ),
+    )
+    payout_response.side_effect = lambda **kwargs: dict(
+        stripe_response_payout, id="po_%s" % kwargs["idempotency_key"]
+    )
+    # Queued by a process that was restarted before its thread ran the job
+    left_job = PayoutJob.objects.create(vendor=vendor, amount=20)
+
+    with mock.patch("snap.apps.vendor.utils.payout_job_executor") as executor:
+        job = submit_payout_job(vendor, 20)
+    run, *args = executor.submit.call_args.args
+    assert args == [process_submitted_payout_job, job.pk]
+
+    assert process_submitted_payout_job(job.pk) == 2
+    job.refresh_from_db()
+    left_job.refresh_from_db()
+    assert job.status == PayoutJob.SUCCEEDED
+    assert left_job.status == PayoutJob.SUCCEEDED
+    assert job.started <= left_job.started
+
+
+@mock.patch("stripe.Account.retrieve", return_value=stripe_account_mock_data)
+@mock.patch("stripe.Payout.create", return_value=stripe_response_payout)
+@mock.patch("stripe.Balance.retrieve", return_value=stripe_balance_mock_data)
+@pytest.mark.django_db
+def test_create_payout_concurrent_unapproved(
+    balance_response, payout_response, account_response
+):
+    vendor = VendorFactory(stripe_id="abc123")
+    vendor_balance_withdraw = VendorBalanceWithdraw(user=vendor.user)
+
+    response = vendor_balance_withdraw.create_payout(20.00, concurrent=True)
+    assert response.get("status") == "unapproved"
+    assert not payout_response.called
+
+
+def _main_dashboard_response(vendor):
+    # The view is behind the stale-while-revalidate cache, drop the cached
+    # payload so every call measures a fresh computation
+    cache.clear()
+    bump_vendor_cache_version(vendor.pk, "dashboard")
+    request = APIRequestFactory().get("/api/dashboard/")
+    force_authenticate(request, user=vendor.user)
+    return MainDashboardApiView.as_view()(request)
+
+
+@pytest.mark.django_db
+def test_main_dashboard_query_count_is_fixed():
+    vendor = VendorFactory()
+
+    def _completed_order():
+        order = OrderFactory(status="completed")
+        payment = PaymentFactory(status="success", order=order, amount=20)
+        TransactionFactory(vendor=vendor, payment=payment)
+
+    _completed_order()
+    small = _main_dashboard_response(vendor)
+    for _ in range(10):
+        _completed_order()
+    large = _main_dashboard_response(vendor)
+
+    assert small.data.get("total_orders") == 1
+    assert small["X-Query-Count"] == large["X-Query-Count"]
+    assert int(large["X-Query-Count"]) <= 5
+    assert large["Server-Timing"].startswith("total;dur=")
+    assert large.data.get("total_orders") == 11
+    assert len(large.data.get("orders")) == 5
+
+
+class _CachedDashboardView(APIView):
+    calls = 0
+
+    @vendor_response_cache(fresh_for=60, max_stale=600)
+    def get(self, request, format=None):
+        type(self).calls += 1
+        return Response(
+            {"calls": self.calls},
+            headers={"X-Query-Count": str(self.calls), "X-Vendor": "cached"},
+        )
+
+
+@pytest.mark.django_db
+def test_vendor_response_cache_serves_stale_and_refreshes_once():
+    cache.clear()
+    _CachedDashboardView.calls = 0
+    vendor = VendorFactory()
+
+    def _get():
+        request = APIRequestFactory().get("/api/cached/")
+        force_authenticate(request, user=vendor.user)
+        return _CachedDashboardView.as_view()(request)
+
+    with mock.patch("snap.apps.marketplace.cache.time") as clock, mock.patch(
+        "snap.apps.marketplace.cache.refresh_executor"
+    ) as executor, mock.patch("snap.apps.marketplace.cache.connection"):
+        clock.time.return_value = 1000
+        first = _get()
+        assert first.data == {"calls": 1}
+        assert first["X-Query-Count"] == "1"
+
+        # A hit replays the payload without the numbers of the first request
+        hit = _get()
+        assert hit.data == {"calls": 1}
+        assert hit["X-Vendor"] == "cached"
+        assert not hit.has_header("X-Query-Count")
+        assert not executor.submit.called
+
+        # A new version serves the old entry and schedules a single refresh
+        bump_vendor_cache_version(vendor.pk, "dashboard")
+        assert _get().data == {"calls": 1}
+        assert _get().data == {"calls": 1}
+        assert executor.submit.call_count == 1
+        refresh, *args = executor.submit.call_args.args
+        refresh(*args, **executor.submit.call_args.kwargs)
+        assert _get().data == {"calls": 2}
+
+        # An old entry of the current version is also refreshed in the background
+        clock.time.return_value = 1000 + 61
+        assert _get().data == {"calls": 2}
+        assert executor.submit.call_count == 2
+
+        # Past max_stale the request computes the response itself
+        clock.time.return_value = 1000 + 601
+        response = _get()
+        assert response.data == {"calls": 3}
+        assert response["X-Query-Count"] == "3"
+        assert executor.submit.call_count == 2
+
+
+def _rolled_up_income(vendor):
+    return {
+        (income.category, income.day): income.amount
+        for income in DailyIncome.objects.filter(vendor=vendor)
+    }
+
+
+def _live_income(vendor):
+    rows = (
+        DailyIncome.completed_payments()
+        .filter(vendor=vendor)
+        .annotate(day=TruncDate("created"))
+        .values("day", category=F("payment__order__product__categories__name"))
+        .annotate(amount=Sum("payment__amount"))
+        .order_by()
+    )
+    return {(row["category"], row["day"]): row["amount"] for row in rows}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_daily_income_follows_orders_payments_and_transactions():
+    cache.clear()
+    vendor = VendorFactory()
+    order = OrderFactory(status="pending")
+    payment = PaymentFactory(status="success", order=order, amount=20)
+    TransactionFactory(vendor=vendor, payment=payment)
+    assert _rolled_up_income(vendor) == {}
+
+    order.status = "completed"
+    order.save()
+    assert _rolled_up_income(vendor) == _live_income(vendor)
+    assert sum(_rolled_up_income(vendor).values()) == 20
+
+    rows = IncomeTrackerApiView()._income_rows(vendor, timezone.now().year)
+    assert sum(amount for _, _, amount in rows) == 20
+
+    payment.amount = 35
+    payment.save()
+    other_order = OrderFactory(status="completed")
+    TransactionFactory(
+        vendor=vendor,
+        payment=PaymentFactory(status="success", order=other_order, amount=5),
+    )
+    assert _rolled_up_income(vendor) == _live_income(vendor)
+
+    # The cached rows of the year follow the new income version
+    rows = IncomeTrackerApiView()._income_rows(vendor, timezone.now().year)
+    assert sum(amount for _, _, amount in rows) == 40
+
+
+@pytest.mark.django_db(transaction=True)
+def test_daily_income_refreshes_of_the_same_day_run_side_by_side():
+    vendor = VendorFactory()
+    for amount in (20, 5):
+        TransactionFactory(
+            vendor=vendor,
+            payment=PaymentFactory(
+                status="success", order=OrderFactory(status="completed"), amount=amount
+            ),
+        )
+    day = timezone.localdate()
+    barrier = threading.Barrier(2)
+    errors = []
+
+    def _refresh():
+        try:
+            barrier.wait()
+            DailyIncome.refresh(vendor.pk, day)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=_refresh) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert _rolled_up_income(vendor) == _live_income(vendor)
+    assert sum(_rolled_up_income(vendor).values()) == 25
+
+
+def _period(**params):
+    request = Request(APIRequestFactory().get("/api/income/", params))
+    return IncomeTrackerApiView()._period(request)
+
+
+def test_income_tracker_period():
+    today = datetime.date.today()
+    assert _period() == (
+        today.year,
+        1,
+        12,
+        today - datetime.timedelta(today.weekday()),
+    )
+    assert _period(year=2019, start_month=3, end_month=5, week=10) == (
+        2019,
+        3,
+        5,
+        datetime.date(2019, 3, 4),
+    )
+    # A past year without a week defaults to its last ISO week
+    assert _period(year=2019)[3] == datetime.date(2019, 12, 23)
+
+    for params in (
+        {"start_month": 5, "end_month": 3},
+        {"end_month": 13},
+        {"year": "abc"},
+        {"week": 54},
+    ):
+        with pytest.raises(ValueError):
+            _period(**params)
+
+
+def _income_tracker_response(vendor, params):
+    cache.clear()
+    request = APIRequestFactory().get("/api/income/", params)
+    force_authenticate(request, user=vendor.user)
+    return IncomeTrackerApiView.as_view()(request)
+
+
+@pytest.mark.django_db
+def test_income_tracker_compares_week_and_month_range():
+    vendor = VendorFactory()
+    for day, amount in (
+        (datetime.date(2019, 3, 5), 10),
+        (datetime.date(2019, 4, 1), 20),
+        (datetime.date(2019, 7, 1), 100),
+        (datetime.date(2018, 3, 6), 15),
+        (datetime.date(2018, 8, 1), 50),
+    ):
+        DailyIncome.objects.create(
+            vendor=vendor, category="Shoes", day=day, amount=amount
+        )
+
+    response = _income_tracker_response(
+        vendor,
+        {"year": 2019, "start_month": 3, "end_month": 4, "week": 10, "compare": "true"},
+    )
+    assert response.status_code == 200
+    assert response.data["total_earned"] == 30
+    assert response.data["week_total_earned"] == 10
+    assert response.data["income_data"]["month"]["labels"] == ["March", "April"]
+    comparison = response.data["comparison"]
+    assert comparison["year"] == 2018
+    assert comparison["total_earned"] == 15
+    assert comparison["change_percentage"] == 100
+
+    response = _income_tracker_response(vendor, {"start_month": 5, "end_month": 3})
+    assert response.status_code == 400
+    assert response.data == {"error": "Invalid period."}
+
+
+@pytest.mark.django_db
+def test_dashboard_operations_walk_full_history():
+    vendor = VendorFactory()
+    for _ in range(5):
+        order = OrderFactory(status="completed")
+        payment = PaymentFactory(status="success", order=order, amount=20)
+        TransactionFactory(vendor=vendor, payment=payment)
+    view = DashboardOperationsApiView.as_view()
+    url = "/api/dashboard/operations/?page_size=2"
+    seen = []
+    while url:
+        request = APIRequestFactory().get(url)
+        force_authenticate(request, user=vendor.user)
+        response = view(request)
+        seen.extend(operation["id"] for operation in response.data["results"])
+        url = response.data["next"]
+
+    assert len(seen) == len(set(seen)) == 5
+    assert {operation.amount for operation in vendor.operations.all()} == {20}
+    assert set(vendor.operations.values_list("source", flat=True)) == {"payment"}
+
+
+@mock.patch(
+    "stripe.checkout.Session.create",
+    return_value={"id": "cs_test_123", "object": "checkout.session", "status": "open"},
+)
+@pytest.mark.django_db
+def test_stripe_checkout_session_create_reuses_open_session(session_response):
+    user = UserFactory()
+    product = mock.Mock(
+        pk=1,
+        title="Shirt",
+        to_line_item={"name": "Shirt", "currency": "eur"},
+        stripe_metadata={},
+    )
+    kwargs = dict(
+        product=product,
+        quantity=1,
+        amount=20,
+        user=user,
+        success_url="https://example.com",
+        cancel_url="https://example.com",
+    )
+
+    assert stripe_checkout_session_create(**kwargs).get("id") == "cs_test_123"
+    assert stripe_checkout_session_create(**kwargs).get("id") == "cs_test_123"
+    assert session_response.call_count == 1
+
+    stripe_checkout_session_create(**dict(kwargs, quantity=2))
+    assert session_response.call_count == 2
+
+    first_key = session_response.call_args.kwargs["idempotency_key"]
+    stripe_checkout_session_completed(
+        {"type": "checkout.session.completed", "data": {"object": {"id": "cs_test_123"}}}
+    )
+    stripe_checkout_session_create(**dict(kwargs, quantity=2))
+    assert session_response.call_count == 3
+    # A new session, not the replay of the completed one
+    assert session_response.call_args.kwargs["idempotency_key"] != first_key
+
+
+@pytest.mark.django_db
+def test_product_stripe_metadata_is_built_and_trimmed():
+    cache.clear()
+    product = ProductFactory(title="Shirt", upc=None)
+
+    metadata = product.build_stripe_metadata()
+    assert metadata["product_id"] == str(product.pk)
+    assert metadata["title"] == "Shirt"
+    assert "upc" not in metadata
+    assert all(isinstance(value, str) for value in metadata.values())
+
+    with mock.patch("snap.apps.catalogue.models.STRIPE_METADATA_MAX_KEYS", 2), mock.patch(
+        "snap.apps.catalogue.models.STRIPE_METADATA_VALUE_LENGTH", 3
+    ), mock.patch("snap.apps.catalogue.models.STRIPE_METADATA_KEY_LENGTH", 5):
+        trimmed = product.build_stripe_metadata()
+    assert trimmed == {"produ": str(product.pk)[:3], "title": "Shi"}
+
+    product.title = "Trousers"
+    product.save()
+    assert product.stripe_metadata["title"] == "Trousers"
+
+    def _attribute_values(metadata):
+        return sorted(
+            value for key, value in metadata.items() if key.startswith("attr_")
+        )
+
+    # Codes that only differ after the key length get their own keys
+    values = []
+    for suffix in ("a", "b"):
+        code = "fabric_of_the_outer_layer_of_the_trousers_%s" % suffix
+        attribute = product.product_class.attributes.create(
+            name=code, code=code, type="text"
+        )
+        values.append(
+            ProductAttributeValue.objects.create(
+                product=product, attribute=attribute, value_text=suffix
+            )
+        )
+    metadata = product.stripe_metadata
+    assert _attribute_values(metadata) == ["a", "b"]
+    assert all(len(key) <= 40 for key in metadata)
+
+    # Deleting a value forgets the cached metadata instead of building it again
+    values[0].delete()
+    assert cache.get("product:stripe_metadata:%s" % product.pk) is None
+    assert _attribute_values(product.stripe_metadata) == ["b"]
+    product_pk = product.pk
+    product.delete()
+    assert cache.get("product:stripe_metadata:%s" % product_pk) is None
+
+
+def _summary_fields(summary):
+    return (summary.counts, summary.total, summary.score_sum, summary.top_review_id)
+
+
+@pytest.mark.django_db
+def test_rating_summary_incremental_counts_match_rebuild():
+    product = ProductFactory()
+    five = ProductReviewFactory(product=product, score=5, delta_votes=1)
+    three = ProductReviewFactory(product=product, score=3, delta_votes=4)
+    ProductReviewFactory(product=product, score=3, delta_votes=0)
+    assert product.rating_summary.top_review == three
+
+    three.score = 1
+    three.save()
+    five.delta_votes = 10
+    five.save()
+    three.delete()
+
+    summary = ProductRatingSummary.objects.get(product=product)
+    assert summary.counts == {1: 0, 2: 0, 3: 1, 4: 0, 5: 1}
+    assert summary.total == 2
+    assert summary.average == 4
+    assert summary.top_review == five
+
+    ProductRatingSummary.rebuild(product_ids=[product.pk])
+    assert _summary_fields(summary) == _summary_fields(
+        ProductRatingSummary.objects.get(product=product)
+    )
+
+
+@pytest.mark.django_db
+def test_rating_summary_missing_is_counted_from_all_reviews():
+    product = ProductFactory()
+    reviews = [ProductReviewFactory(product=product, score=4) for _ in range(3)]
+    # Reviews from before the summaries existed
+    ProductRatingSummary.objects.all().delete()
+
+    reviews[0].delta_votes = 5
+    reviews[0].save()
+    summary = ProductRatingSummary.objects.get(product=product)
+    assert summary.total == 3
+    assert summary.top_review == reviews[0]
+
+    ProductRatingSummary.objects.all().delete()
+    ProductReviewFactory(product=product, score=2)
+    summary = ProductRatingSummary.objects.get(product=product)
+    assert summary.counts == {1: 0, 2: 1, 3: 0, 4: 3, 5: 0}
+    assert summary.total == 4
+
+
+@pytest.mark.django_db(transaction=True)
+def test_product_search_document_follows_product_and_attributes():
+    product = ProductFactory(title="Crimson shirt")
+    attribute = product.product_class.attributes.create(
+        name="Fabric", code="fabric", type="text"
+    )
+    ProductAttributeValue.objects.create(
+        product=product, attribute=attribute, value_text="linen"
+    )
+
+    for search in ("crim", "shirt", "lin"):
+        found = ProductSearchDocument.search(Product.objects.all(), search)
+        assert list(found) == [product]
+    assert not ProductSearchDocument.search(Product.objects.all(), "wool").exists()
+    assert ProductSearchDocument.objects.filter(product=product).count() == 1
+
+    # Deleting the attribute values with the product must not index it again
+    product.delete()
+    assert not ProductSearchDocument.objects.exists()
+
+
+def _product_list_queries(rf, products):
+    request = rf.get("/api/products/")
+    request.user = AnonymousUser()
+    queryset = ProductSerializer.setup_eager_loading(
+        Product.objects.filter(pk__in=[product.pk for product in products])
+    )
+    with CaptureQueriesContext(connection) as queries:
+        ProductSerializer(queryset, context={"request": request}, many=True).data
+    return len(queries)
+
+
+@pytest.mark.django_db
+def test_product_serializer_query_count_is_independent_of_page_size(rf):
+    def _product_with_relations():
+        product = ProductFactory(categories=[CategoryFactory()])
+        ProductImageFactory(product=product)
+        ProductReviewFactory(product=product, score=5)
+        ProductReviewFactory(product=product, score=2)
+        return product
+
+    small_page = [_product_with_relations() for _ in range(2)]
+    large_page = small_page + [_product_with_relations() for _ in range(4)]
+
+    assert _product_list_queries(rf, small_page) == _product_list_queries(rf, large_page)
+
+
+def _variant_ids(variants):
+    return sorted(variant["id"] for variant in variants)
+
+
+@pytest.mark.django_db
+def test_variant_loader_serializes_families_in_fixed_queries():
+    def _family(children):
+        parent = ProductFactory(structure="parent")
+        return [parent] + [
+            ProductFactory(structure="child", parent=parent) for _ in range(children)
+        ]
+
+    parent, first, second = _family(2)
+    attribute = first.product_class.attributes.create(
+        name="Size", code="size", type="text"
+    )
+    ProductAttributeValue.objects.create(
+        product=first, attribute=attribute, value_text="M"
+    )
+
+    loader = ProductVariantLoader([parent, first])
+    assert _variant_ids(loader.variants(parent)) == sorted([first.pk, second.pk])
+    # A child lists its parent and its siblings, not itself
+    assert _variant_ids(loader.variants(first)) == sorted([parent.pk, second.pk])
+    first_variant = next(
+        variant for variant in loader.variants(parent) if variant["id"] == first.pk
+    )
+    assert [attr["code"] for attr in first_variant["attributes"]] == ["size"]
+
+    def _queries(page):
+        with CaptureQueriesContext(connection) as queries:
+            loader = ProductVariantLoader(page)
+            for product in page:
+                loader.variants(product)
+        return len(queries)
+
+    small_page = [parent, first]
+    large_page = small_page + _family(3) + _family(1)[1:] + [ProductFactory()]
+    assert _queries(small_page) == _queries(large_page) == 2
+
+
+def _vendor_products(vendor, url):
+    request = APIRequestFactory().get(url)
+    force_authenticate(request, user=vendor.user)
+    return ProductApiView.as_view({"get": "vendor_products"})(request)
+
+
+@pytest.mark.django_db
+def test_vendor_products_walk_cursor_pages_and_stream_in_chunks(rf):
+    vendor = VendorFactory()
+    products = [ProductFactory(vendor=vendor) for _ in range(5)]
+    ProductFactory()
+    product_ids = sorted(product.pk for product in products)
+
+    ids, pages = [], 0
+    url = "/api/products/vendor_products/?page_size=2"
+    while url:
+        response = _vendor_products(vendor, url)
+        assert response.status_code == 200
+        ids += [product["id"] for product in response.data["results"]]
+        url = response.data["next"]
+        pages += 1
+    assert ids == product_ids
+    assert pages == 3
+
+    response = _vendor_products(vendor, "/api/products/vendor_products/?stream=true")
+    assert response["Content-Type"] == "application/x-ndjson"
+    lines = b"".join(response.streaming_content).decode().splitlines()
+    assert [json.loads(line)["id"] for line in lines] == product_ids
+
+    # Every chunk is serialized on its own with the eager loading applied
+    request = rf.get("/api/products/")
+    request.user = AnonymousUser()
+    with mock.patch(
+        "snap.apps.marketplace.api_views.serializers.ProductSerializer",
+        wraps=ProductSerializer,
+    ) as serializer:
+        streamed = list(
+            stream_products(
+                Product.objects.filter(vendor=vendor).order_by("id"),
+                {"request": request},
+                chunk_size=2,
+            )
+        )
+    assert [json.loads(line)["id"] for line in streamed] == product_ids
+    assert [len(call.args[0]) for call in serializer.call_args_list] == [2, 2, 1]
+    assert serializer.setup_eager_loading.call_count == 3
+
+
+@pytest.mark.django_db
+def test_keyset_pagination_walks_all_pages():
+    users = [UserFactory(username=f"user{number}") for number in range(5)]
+    paginator = KeysetPagination()
+    factory = APIRequestFactory()
+    url = "/api/users/?page_size=2"
+    seen = []
+    while url:
+        request = Request(factory.get(url))
+        page = paginator.paginate_queryset(User.objects.order_by("-id"), request)
+        seen.extend(user.id for user in page)
+        url = paginator.get_next_link()
+
+    assert seen == sorted((user.id for user in users), reverse=True)
+    assert paginator.count == 5
+    assert not paginator.count_is_approximate
+
+    request = Request(factory.get(paginator.get_previous_link()))
+    page = paginator.paginate_queryset(User.objects.order_by("-id"), request)
+    assert [user.id for user in page] == seen[2:4]
+
+    # A nullable column can't be compared with a cursor, the default is used
+    request = Request(factory.get("/api/users/?page_size=2"))
+    paginator.paginate_queryset(User.objects.order_by("last_login"), request)
+    assert paginator.ordering == ("-id",)
+
+    # Cursors that aren't ours start from the first page
+    for cursor in ([1, 2], "page", {"p": ["abc"], "o": ["-id"], "r": False}):
+        encoded = base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+        request = Request(factory.get("/api/users/", {"cursor": encoded}))
+        page = paginator.paginate_queryset(User.objects.order_by("-id"), request)
+        assert [user.id for user in page] == seen[:20]
+
+
+def _review_page(product, page):
+    request = APIRequestFactory().get(
+        "/api/reviews/", {"product": product.pk, "page": page, "page_size": 1}
+    )
+    view = ReviewSectionApiView.as_view({"get": "list"})
+    return view(request)
+
+
+@pytest.mark.django_db
+def test_review_list_windows_page_range_and_caches_count():
+    cache.clear()
+    product = ProductFactory()
+    for _ in range(9):
+        ProductReviewFactory(product=product)
+
+    response = _review_page(product, 5)
+    assert response.data["num_pages"] == [1, None, 3, 4, 5, 6, 7, None, 9]
+    assert response.data["current_page"] == 5
+    assert response.data["last_page"] == 9
+    assert _review_page(product, 1).data["num_pages"] == [1, 2, 3, None, 9]
+
+    with CaptureQueriesContext(connection) as queries:
+        _review_page(product, 2)
+    assert not any("COUNT(" in query["sql"] for query in queries.captured_queries)
+
+    ProductReviewFactory(product=product)
+    assert _review_page(product, 1).data["count"] == 10
+
+
+def _bulk_post_campaigns(user, items):
+    request = APIRequestFactory().post("/api/campaigns/", items, format="json")
+    force_authenticate(request, user=user)
+    return CampaignListApiView.as_view()(request)
+
+
+@pytest.mark.django_db
+def test_campaign_bulk_post_writes_nothing_when_an_item_is_invalid():
+    user = UserFactory()
+
+    response = _bulk_post_campaigns(
+        user,
+        [{"name": "Spring"}, {"id": "abc", "name": "Summer"}, {"id": 999999, "name": "Fall"}],
+    )
+    assert response.status_code == 400
+    assert [item["status"] for item in response.data] == ["valid", "invalid", "not_found"]
+    assert "id" in response.data[1]["errors"]
+    assert not Campaign.objects.filter(user=user).exists()
+
+
+@pytest.mark.django_db
+def test_campaign_bulk_post_creates_and_updates():
+    user = UserFactory()
+
+    response = _bulk_post_campaigns(user, [{"name": "Spring"}, {"name": "Summer"}])
+    assert response.status_code == 200
+    assert [item["status"] for item in response.data] == ["created", "created"]
+    spring_id = response.data[0]["campaign"]["id"]
+
+    with CaptureQueriesContext(connection) as queries:
+        response = _bulk_post_campaigns(
+            user,
+            [{"name": "Fall"}, {"id": spring_id, "name": "Winter"}, {"name": "Autumn"}],
+        )
+    assert [item["status"] for item in response.data] == [
+        "created",
+        "updated",
+        "created",
+    ]
+    assert Campaign.objects.get(pk=spring_id).name == "Winter"
+    assert Campaign.objects.filter(user=user).count() == 4
+    # Both new campaigns are written with one INSERT
+    inserts = [query for query in queries if query["sql"].startswith("INSERT")]
+    assert len(inserts) == 1
+
+    # The same campaign twice in one list is rejected
+    response = _bulk_post_campaigns(
+        user, [{"id": spring_id, "name": "Spring"}, {"id": spring_id, "name": "Fall"}]
+    )
+    assert response.status_code == 400
+    assert [item["status"] for item in response.data] == ["valid", "invalid"]
+    assert Campaign.objects.get(pk=spring_id).name == "Winter"
+
+
+@pytest.mark.django_db
+def test_cached_token_authentication(django_assert_num_queries):
+    user = UserFactory()
+    token = Token.objects.create(user=user)
+    authentication = CachedTokenAuthentication()
+    request = APIRequestFactory().get("/api/campaigns/", HTTP_AUTHORIZATION=token.key)
+
+    assert authentication.authenticate(request)[0] == user
+    with django_assert_num_queries(0):
+        assert authentication.authenticate(request)[0] == user
+
+    token.delete()
+    with pytest.raises(AuthenticationFailed):
+        authentication.authenticate(request)
 
 
 @pytest.mark.django_db